@@ -2,7 +2,6 @@ from flask import Flask
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-from routers.router import router
 from logging_utils import init_request_logging
 
 load_dotenv()
@@ -11,7 +10,13 @@ app = Flask(__name__)
 CORS(app, origins=os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:5173").split(","))
 
 init_request_logging(app, "soa-login")
+
+# Imported once logging is set up: the services pick up its logger and
+# RabbitMQ connection when they are created.
+from routers.router import router, well_known  # noqa: E402
+
 app.register_blueprint(router)
+app.register_blueprint(well_known)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8001))
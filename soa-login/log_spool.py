@@ -0,0 +1,125 @@
+import fcntl
+import mmap
+import os
+import struct
+from typing import Optional, Tuple
+
+MAGIC = b"LOGSPL01"
+# magic, read offset, write offset
+HEADER = struct.Struct("<8sQQ")
+# body length, records in the body
+FRAME = struct.Struct("<II")
+
+
+class SpoolLocked(Exception):
+    """Another process already has this spool file open."""
+
+
+class Spool:
+    """
+    Append-only, size-capped file of log batches waiting for the broker. The
+    file is memory-mapped, so an append is a memory copy, and whatever was
+    spooled survives a restart of the service. Batches are read back in the
+    order they were written. Space in front of the read offset is reclaimed
+    once the unread tail fits there; past `capacity`, appends are refused.
+
+    The file is locked (`flock`) from open to `close`; opening a spool that
+    another process holds raises `SpoolLocked` before anything is touched.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise SpoolLocked(path)
+        try:
+            size = os.fstat(fd).st_size
+            header = None
+            if size >= HEADER.size:
+                header = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            valid = (
+                header is not None
+                and header[0] == MAGIC
+                and HEADER.size <= header[1] <= header[2] <= size
+            )
+            if valid and header[1] < header[2]:
+                # Unread batches from an earlier run: keep the file as it is.
+                capacity = size
+            else:
+                valid = False
+                capacity = max(capacity, HEADER.size + FRAME.size + 1)
+                os.ftruncate(fd, capacity)
+            self.capacity = capacity
+            self._mm = mmap.mmap(fd, capacity)
+        except BaseException:
+            os.close(fd)
+            raise
+        # Kept open only to hold the lock.
+        self._fd = fd
+
+        if valid:
+            self._read, self._write = header[1], header[2]
+        else:
+            self._read = self._write = HEADER.size
+            self._store()
+        self.records = 0
+        offset = self._read
+        while offset < self._write:
+            length, records = FRAME.unpack_from(self._mm, offset)
+            self.records += records
+            offset += FRAME.size + length
+
+    def _store(self):
+        HEADER.pack_into(self._mm, 0, MAGIC, self._read, self._write)
+
+    def __len__(self) -> int:
+        return self._write - self._read
+
+    def append(self, body: bytes, records: int) -> bool:
+        """Add one batch; False when it does not fit."""
+        need = FRAME.size + len(body)
+        if self._write + need > self.capacity:
+            self._compact()
+            if self._write + need > self.capacity:
+                return False
+        FRAME.pack_into(self._mm, self._write, len(body), records)
+        self._mm[self._write + FRAME.size:self._write + need] = body
+        # The header moves last, so a crash never exposes a half-written frame.
+        self._write += need
+        self._store()
+        self.records += records
+        return True
+
+    def peek(self) -> Optional[Tuple[bytes, int]]:
+        """Oldest batch and its record count, or None when empty."""
+        if self._read == self._write:
+            return None
+        length, records = FRAME.unpack_from(self._mm, self._read)
+        start = self._read + FRAME.size
+        return self._mm[start:start + length], records
+
+    def pop(self):
+        length, records = FRAME.unpack_from(self._mm, self._read)
+        self._read += FRAME.size + length
+        if self._read == self._write:
+            self._read = self._write = HEADER.size
+        self._store()
+        self.records -= records
+
+    def _compact(self):
+        unread = self._write - self._read
+        # Only when source and target do not overlap, so the frames the
+        # header still points at stay intact until it is rewritten.
+        if self._read == HEADER.size or unread > self._read - HEADER.size:
+            return
+        self._mm.move(HEADER.size, self._read, unread)
+        self._read, self._write = HEADER.size, HEADER.size + unread
+        self._store()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        os.close(self._fd)
@@ -1,27 +1,98 @@
 import contextvars
+import gzip
 import json
 import logging
 import os
+import queue
+import random
+import tempfile
+import threading
 import time
+import zlib
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Dict, Optional
 from uuid import uuid4
 
 import pika
 from flask import request, g
 
+from log_spool import Spool, SpoolLocked
+
+try:
+    import zstandard
+except ImportError:  # only needed for LOG_PUBLISH_ENCODING=zstd
+    zstandard = None
+
 correlation_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
     "correlation_id", default=None
 )
 
+# Spans of the current request, next to its correlation id; None outside a request.
+spans_var: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "spans", default=None
+)
+
 _logger: Optional[logging.Logger] = None
 _service_name: Optional[str] = None
+_rabbit_handler: Optional["RabbitMQHandler"] = None
 
 
 def get_correlation_id() -> Optional[str]:
     return correlation_id_var.get()
 
 
+class Span:
+    """
+    Times a block of the current request under `name`. Outside a request it
+    does nothing; inside one it costs two clock reads and a list append.
+    """
+
+    __slots__ = ("name", "_spans", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._spans = spans_var.get()
+        if self._spans is not None:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._spans is not None:
+            self._spans.append((self.name, time.perf_counter() - self._start))
+        return False
+
+
+def span(name: str) -> Span:
+    """`with span("db"): ...` adds the block's duration to the request's `name` timing."""
+    return Span(name)
+
+
+def request_timings() -> Dict[str, dict]:
+    """Spans of the current request summed per name: {name: {"ms", "count"}}."""
+    timings: Dict[str, dict] = {}
+    for name, seconds in spans_var.get() or ():
+        timing = timings.get(name)
+        if timing is None:
+            timing = timings[name] = {"ms": 0.0, "count": 0}
+        timing["ms"] += seconds * 1000
+        timing["count"] += 1
+    for timing in timings.values():
+        timing["ms"] = round(timing["ms"], 2)
+    return timings
+
+
+def server_timing(timings: Dict[str, dict], total_ms: Optional[float]) -> str:
+    metrics = [
+        f'{name};dur={timing["ms"]:.2f}' + (f';desc="{timing["count"]}x"' if timing["count"] > 1 else "")
+        for name, timing in timings.items()
+    ]
+    if total_ms is not None:
+        metrics.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(metrics)
+
+
 def _rabbit_config():
     return {
         "host": os.getenv("RABBITMQ_HOST", "localhost"),
@@ -31,27 +102,153 @@ def _rabbit_config():
         "exchange": os.getenv("RABBITMQ_EXCHANGE", "logs-exchange"),
         "queue": os.getenv("RABBITMQ_QUEUE", "logs-queue"),
         "routing_key": os.getenv("RABBITMQ_ROUTING_KEY", "logs.route"),
+        "heartbeat": int(os.getenv("RABBITMQ_HEARTBEAT", "30")),
+        "queue_size": int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+        "queue_policy": os.getenv("LOG_QUEUE_POLICY", "drop"),
+        "block_timeout": float(os.getenv("LOG_QUEUE_BLOCK_TIMEOUT", "0.5")),
+        "batch_size": int(os.getenv("LOG_PUBLISH_BATCH_SIZE", "100")),
+        "encoding": os.getenv("LOG_PUBLISH_ENCODING", "gzip"),
+        "connect_timeout": float(os.getenv("LOG_CONNECT_TIMEOUT", "2")),
+        "breaker_threshold": int(os.getenv("LOG_BREAKER_THRESHOLD", "3")),
+        "breaker_max_backoff": float(os.getenv("LOG_BREAKER_MAX_BACKOFF", "60")),
+        "spool_path": os.getenv("LOG_SPOOL_PATH", ""),
+        "spool_bytes": int(os.getenv("LOG_SPOOL_BYTES", str(64 * 1024 * 1024))),
     }
 
 
+QUEUE_POLICIES = ("drop", "block")
+PUBLISH_ENCODINGS = ("identity", "gzip", "zstd")
+BATCH_CONTENT_TYPE = "application/x-ndjson"
+SPOOL_SLOTS = 32
+# Spooled batches replayed per pass, so new records keep being taken in.
+REPLAY_BATCHES = 50
+
+
+class CircuitBreaker:
+    """
+    Closed while calls succeed. After `threshold` consecutive failures it
+    opens for `backoff` seconds, doubling up to `max_backoff` with every
+    failed probe; once that passes, one probe call is let through.
+    """
+
+    def __init__(self, threshold: int = 3, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.threshold = threshold
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self._backoff = backoff
+        self._open_until = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def success(self):
+        self.failures = 0
+        self._backoff = self.base_backoff
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self._open_until = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+
+
+def _open_spool(path: str, capacity: int) -> Spool:
+    """
+    The spool at `path`, or, while other processes (e.g. gunicorn workers)
+    hold it, the first free `<path>.<n>` slot, falling back to one named
+    after the pid. A restarted process takes over the slot an earlier one
+    left, so its backlog is still replayed.
+    """
+    root, ext = os.path.splitext(path)
+    for slot in range(SPOOL_SLOTS):
+        try:
+            return Spool(path if slot == 0 else f"{root}.{slot}{ext}", capacity)
+        except SpoolLocked:
+            continue
+    return Spool(f"{root}.pid{os.getpid()}{ext}", capacity)
+
+
 class RabbitMQHandler(logging.Handler):
+    """
+    Turns records into JSON on the calling thread and hands them to a bounded
+    queue; a background publisher thread owns the broker connection and
+    publishes in batches, each batch as one NDJSON message compressed with
+    `LOG_PUBLISH_ENCODING` (flagged in `content_encoding`). When the queue
+    is full, the "drop" policy discards the record at once and "block" waits
+    up to `block_timeout` for room first. Discarded records are counted in
+    `dropped`.
+
+    While the broker is unreachable a circuit breaker spaces out reconnects
+    and batches go to an on-disk spool instead; once a connection is back the
+    spool is replayed, oldest first, before anything newer is published.
+
+    Other components can share the connection: `broadcast` publishes a small
+    message to a fanout exchange and `subscribe` listens on one, with the
+    callback running on the publisher thread.
+    """
+
     def __init__(self, service_name: str):
         super().__init__()
         cfg = _rabbit_config()
+        if cfg["queue_policy"] not in QUEUE_POLICIES:
+            raise ValueError(f"LOG_QUEUE_POLICY must be one of {QUEUE_POLICIES}")
+        if cfg["encoding"] not in PUBLISH_ENCODINGS:
+            raise ValueError(f"LOG_PUBLISH_ENCODING must be one of {PUBLISH_ENCODINGS}")
+        if cfg["encoding"] == "zstd" and zstandard is None:
+            raise ValueError("LOG_PUBLISH_ENCODING=zstd needs the zstandard package")
         credentials = pika.PlainCredentials(cfg["user"], cfg["password"])
         self.connection_params = pika.ConnectionParameters(
             host=cfg["host"],
             port=cfg["port"],
             credentials=credentials,
-            heartbeat=0,
+            heartbeat=cfg["heartbeat"],
+            # Fail fast on a dead broker; the breaker decides when to retry.
+            connection_attempts=1,
+            socket_timeout=cfg["connect_timeout"],
+            stack_timeout=cfg["connect_timeout"] * 2,
+            blocked_connection_timeout=30,
         )
         self.exchange = cfg["exchange"]
         self.queue = cfg["queue"]
         self.routing_key = cfg["routing_key"]
         self.service_name = service_name
+        self.policy = cfg["queue_policy"]
+        self.block_timeout = cfg["block_timeout"]
+        self.batch_size = cfg["batch_size"]
+        self.encoding = cfg["encoding"]
         self.connection = None
         self.channel = None
-        self._connect()
+
+        self._queue: queue.Queue = queue.Queue(maxsize=cfg["queue_size"])
+        self._stopping = threading.Event()
+        self.published = 0
+        self.dropped = 0
+        self.publish_errors = 0
+
+        self.breaker = CircuitBreaker(
+            cfg["breaker_threshold"], max_backoff=cfg["breaker_max_backoff"]
+        )
+        spool_path = cfg["spool_path"] or os.path.join(
+            tempfile.gettempdir(), f"{service_name}-logs.spool"
+        )
+        self.spool = _open_spool(spool_path, cfg["spool_bytes"])
+
+        # exchange -> (callback, on_subscribed); bound anew on every connection
+        self._subscriptions: Dict[str, tuple] = {}
+        self._bound = set()
+        self._broadcasts: queue.Queue = queue.Queue(maxsize=1000)
+
+        self._publisher = threading.Thread(
+            target=self._run, name=f"{service_name}-log-publisher", daemon=True
+        )
+        self._publisher.start()
 
     def _connect(self):
         if self.connection and getattr(self.connection, "is_open", False):
@@ -65,43 +262,306 @@ class RabbitMQHandler(logging.Handler):
         self.channel.queue_bind(
             queue=self.queue, exchange=self.exchange, routing_key=self.routing_key
         )
+        self._bound = set()
+
+    def _bind_subscriptions(self):
+        for exchange, (callback, on_subscribed) in list(self._subscriptions.items()):
+            if exchange in self._bound:
+                continue
+            self.channel.exchange_declare(exchange=exchange, exchange_type="fanout")
+            declared = self.channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+            self.channel.queue_bind(queue=declared.method.queue, exchange=exchange)
+            self.channel.basic_consume(
+                queue=declared.method.queue,
+                on_message_callback=lambda ch, method, props, body, cb=callback: self._dispatch(cb, body),
+                auto_ack=True,
+            )
+            self._bound.add(exchange)
+            if on_subscribed is not None:
+                on_subscribed()
+
+    def _dispatch(self, callback, body: bytes):
+        try:
+            callback(body)
+        except Exception:
+            pass
+
+    def subscribe(self, exchange: str, callback, on_subscribed=None):
+        """
+        Call `callback(body)` for every message on the fanout `exchange`.
+        `on_subscribed()` runs each time the subscription is (re)established,
+        since messages sent while disconnected are not delivered.
+        """
+        self._subscriptions[exchange] = (callback, on_subscribed)
+
+    def broadcast(self, exchange: str, body: bytes) -> bool:
+        """Queue `body` for the fanout `exchange`; False when the queue is full."""
+        try:
+            self._broadcasts.put_nowait((exchange, body))
+            return True
+        except queue.Full:
+            return False
+
+    def _send_broadcasts(self):
+        pending = []
+        while True:
+            try:
+                pending.append(self._broadcasts.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            while pending:
+                exchange, body = pending[0]
+                self.channel.basic_publish(exchange=exchange, routing_key="", body=body)
+                pending.pop(0)
+        finally:
+            # Whatever could not be sent is tried again on the next connection.
+            for item in pending:
+                try:
+                    self._broadcasts.put_nowait(item)
+                except queue.Full:
+                    break
+
+    def _disconnect(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _payload(self, record: logging.LogRecord) -> bytes:
+        correlation_id = getattr(record, "correlation_id", None) or get_correlation_id()
+        url = getattr(record, "url", "") or getattr(record, "path", "")
+        timestamp = datetime.now(timezone.utc).isoformat()
+        payload = {
+            "timestamp": timestamp,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "service": self.service_name,
+            "correlation_id": correlation_id,
+            "url": url,
+            "method": getattr(record, "method", ""),
+            "status_code": getattr(record, "status_code", None),
+            "detail": getattr(record, "detail", None),
+        }
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None:
+            payload["sample_rate"] = sample_rate
+        spans = getattr(record, "spans", None)
+        if spans:
+            payload["spans"] = spans
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
 
     def emit(self, record: logging.LogRecord):
+        # The correlation id lives in a context variable of the request
+        # thread, so the payload is built here rather than on the publisher.
         try:
-            self._connect()
-            correlation_id = getattr(record, "correlation_id", None) or get_correlation_id()
-            url = getattr(record, "url", "") or getattr(record, "path", "")
-            timestamp = datetime.now(timezone.utc).isoformat()
-            payload = {
-                "timestamp": timestamp,
-                "level": record.levelname,
-                "message": record.getMessage(),
-                "service": self.service_name,
-                "correlation_id": correlation_id,
-                "url": url,
-                "method": getattr(record, "method", ""),
-                "status_code": getattr(record, "status_code", None),
-                "detail": getattr(record, "detail", None),
-            }
-            payload["formatted"] = (
-                f"{timestamp} {record.levelname} {url} "
-                f"Correlation:{correlation_id or '-'} [{self.service_name}] - {payload['message']}"
-            )
-            body = json.dumps(payload).encode("utf-8")
-            self.channel.basic_publish(
-                exchange=self.exchange,
-                routing_key=self.routing_key,
-                body=body,
-                properties=pika.BasicProperties(
-                    content_type="application/json", delivery_mode=2
-                ),
-            )
+            body = self._payload(record)
         except Exception:
             self.handleError(record)
+            return
+        try:
+            if self.policy == "block":
+                self._queue.put(body, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(body)
+        except queue.Full:
+            self.dropped += 1
+
+    def _take_batch(self, timeout: float) -> list:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _encode(self, body: bytes) -> bytes:
+        if self.encoding == "gzip":
+            return gzip.compress(body, compresslevel=6)
+        if self.encoding == "zstd":
+            return zstandard.ZstdCompressor().compress(body)
+        return body
+
+    def _send(self, body: bytes):
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=self.routing_key,
+            body=self._encode(body),
+            properties=pika.BasicProperties(
+                content_type=BATCH_CONTENT_TYPE,
+                content_encoding=None if self.encoding == "identity" else self.encoding,
+                delivery_mode=2,
+            ),
+        )
+
+    def _to_spool(self, batch: list):
+        if not self.spool.append(b"\n".join(batch), len(batch)):
+            self.dropped += len(batch)
+
+    def _deliver(self, batch: list):
+        # Anything newer than the spool goes behind it, so order is kept.
+        if batch and (len(self.spool) or not self.breaker.allow()):
+            self._to_spool(batch)
+            batch = []
+        if not self.breaker.allow():
+            return
+        try:
+            self._connect()
+            self._bind_subscriptions()
+            for _ in range(REPLAY_BATCHES):
+                spooled = self.spool.peek()
+                if spooled is None:
+                    break
+                self._send(spooled[0])
+                self.spool.pop()
+                self.published += spooled[1]
+            if batch:
+                self._send(b"\n".join(batch))
+                self.published += len(batch)
+            self._send_broadcasts()
+            # Keeps heartbeats flowing and runs subscription callbacks.
+            self.connection.process_data_events(time_limit=0)
+            self.breaker.success()
+        except Exception:
+            self.publish_errors += 1
+            self.breaker.failure()
+            self._disconnect()
+            if batch:
+                self._to_spool(batch)
+
+    def _run(self):
+        while True:
+            # Don't wait on the queue while there is a backlog to replay.
+            replaying = len(self.spool) and self.breaker.allow()
+            batch = self._take_batch(0 if replaying else 1.0)
+            if self._stopping.is_set() and not batch and self._queue.empty():
+                break
+            self._deliver(batch)
+        self._disconnect()
+        self.spool.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "published": self.published,
+            "dropped": self.dropped,
+            "publish_errors": self.publish_errors,
+            "connected": bool(self.connection and self.connection.is_open),
+            "circuit": self.breaker.state,
+            "spool_path": self.spool.path,
+            "spooled": self.spool.records,
+            "spool_bytes": len(self.spool),
+        }
+
+    def close(self, timeout: float = 5.0):
+        """
+        Stop accepting records and give the publisher `timeout` to drain the
+        queue, to the broker or else to the spool.
+        """
+        self._stopping.set()
+        self._publisher.join(timeout)
+        super().close()
+
+
+def _sampling_config():
+    return {
+        "default_rate": float(os.getenv("LOG_SAMPLE_RATE", "1")),
+        "route_rates": _parse_route_rates(os.getenv("LOG_SAMPLE_ROUTES", "")),
+        "slow_ms": float(os.getenv("LOG_SAMPLE_SLOW_MS", "1000")),
+        "target_per_sec": float(os.getenv("LOG_SAMPLE_TARGET_PER_SEC", "0")),
+    }
+
+
+def _parse_route_rates(spec: str) -> Dict[str, float]:
+    """`"GET /users/<user_id>=0.05,/users/=0.5"` -> {route: rate}; a route may carry a method."""
+    rates = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        route, _, rate = item.rpartition("=")
+        rates[route.strip()] = float(rate)
+    return rates
+
+
+class AccessLogSampler:
+    """
+    Decides which "Request handled" records are logged. Errors (4xx/5xx) and
+    requests slower than `slow_ms` are always kept; the rest are kept at the
+    route's rate, looked up as "METHOD rule" and then "rule" in
+    `route_rates`, else `default_rate`. With `target_per_sec`, a busy route's
+    rate is lowered further so it keeps about that many records per second,
+    re-evaluated from its observed request rate every `window` seconds.
+
+    The keep decision hashes the correlation id against the rate, so every
+    service sampling at the same rate keeps or drops a request's hops
+    together; without an id it falls back to a random draw.
+    """
+
+    def __init__(
+        self,
+        default_rate: float = 1.0,
+        route_rates: Optional[Dict[str, float]] = None,
+        slow_ms: float = 1000.0,
+        target_per_sec: float = 0.0,
+        window: float = 10.0,
+    ):
+        self.default_rate = default_rate
+        self.route_rates = route_rates or {}
+        self.slow_ms = slow_ms
+        self.target_per_sec = target_per_sec
+        self.window = window
+        self._lock = threading.Lock()
+        # route -> [window start, requests in window, adaptive rate]
+        self._windows: Dict[str, list] = {}
+
+    def _adaptive_rate(self, route: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(route)
+            if state is None:
+                state = self._windows[route] = [now, 0, 1.0]
+            state[1] += 1
+            elapsed = now - state[0]
+            # Re-evaluate at the end of a window, or early once a burst has
+            # used up the window's budget.
+            if elapsed >= self.window or state[1] * state[2] > self.target_per_sec * self.window:
+                state[2] = min(1.0, self.target_per_sec * max(elapsed, 1e-6) / state[1])
+                state[0], state[1] = now, 0
+            return state[2]
+
+    def rate(self, method: str, rule: str) -> float:
+        rate = self.route_rates.get(f"{method} {rule}", self.route_rates.get(rule, self.default_rate))
+        if self.target_per_sec > 0:
+            rate = min(rate, self._adaptive_rate(f"{method} {rule}"))
+        return max(0.0, min(rate, 1.0))
+
+    def sample(
+        self,
+        method: str,
+        rule: str,
+        status_code: int,
+        elapsed_ms: Optional[float],
+        correlation_id: Optional[str] = None,
+    ) -> Optional[float]:
+        """The rate the record was kept at, or None to skip it."""
+        if status_code >= 400 or (elapsed_ms is not None and elapsed_ms >= self.slow_ms):
+            return 1.0
+        rate = self.rate(method, rule)
+        if rate >= 1.0:
+            return rate
+        draw = zlib.crc32(correlation_id.encode()) / 2 ** 32 if correlation_id else random.random()
+        return rate if draw < rate else None
 
 
 def setup_logging(service_name: str) -> logging.Logger:
-    global _logger, _service_name
+    global _logger, _service_name, _rabbit_handler
     if _logger:
         return _logger
 
@@ -130,6 +590,7 @@ def setup_logging(service_name: str) -> logging.Logger:
         rabbit_handler = RabbitMQHandler(service_name)
         rabbit_handler.setFormatter(formatter)
         logger.addHandler(rabbit_handler)
+        _rabbit_handler = rabbit_handler
     except Exception as e:
         logger.error("Failed to initialize RabbitMQ logger: %s", e)
 
@@ -145,13 +606,20 @@ def get_logger() -> logging.Logger:
     return logging.getLogger()
 
 
+def get_rabbit_handler() -> Optional[RabbitMQHandler]:
+    """The handler holding the RabbitMQ connection, if it could be set up."""
+    return _rabbit_handler
+
+
 def init_request_logging(app, service_name: str):
     logger = setup_logging(service_name)
+    sampler = AccessLogSampler(**_sampling_config())
 
     @app.before_request
     def _before():
         cid = request.headers.get("X-Correlation-Id") or str(uuid4())
         correlation_id_var.set(cid)
+        spans_var.set([])
         g.correlation_id = cid
         g._start_time = time.perf_counter()
 
@@ -162,6 +630,12 @@ def init_request_logging(app, service_name: str):
         elapsed_ms = None
         if hasattr(g, "_start_time"):
             elapsed_ms = (time.perf_counter() - g._start_time) * 1000
+        timings = request_timings()
+        response.headers["Server-Timing"] = server_timing(timings, elapsed_ms)
+        rule = request.url_rule.rule if request.url_rule else request.path
+        sample_rate = sampler.sample(request.method, rule, response.status_code, elapsed_ms, cid)
+        if sample_rate is None:
+            return response
         logger.info(
             "Request handled",
             extra={
@@ -171,8 +645,16 @@ def init_request_logging(app, service_name: str):
                 "method": request.method,
                 "status_code": response.status_code,
                 "detail": f"{elapsed_ms:.2f}ms" if elapsed_ms is not None else None,
+                # soa-logs rollups count each kept record as 1 / sample_rate requests.
+                "sample_rate": sample_rate,
+                "spans": timings,
             },
         )
         return response
 
+    @app.teardown_request
+    def _teardown(exc):
+        # Worker threads are reused; spans outside a request are not kept.
+        spans_var.set(None)
+
     return logger
@@ -1,10 +1,13 @@
 from flask import Blueprint, request, jsonify
 from services.user_service import UserService
 from services.token_service import TokenService
+from services.password_hasher import HashingOverloaded
+from logging_utils import get_rabbit_handler
 from models.user_model import UserCreate, UserUpdate, UserLogin
 import uuid
 
 router = Blueprint("users", __name__, url_prefix="/users")
+well_known = Blueprint("well_known", __name__, url_prefix="/.well-known")
 user_service = UserService()
 token_service = TokenService()
 
@@ -28,6 +31,8 @@ def register_user():
         user_id = user_service.create_user(user_data)
         return jsonify({"message": "User created successfully", "user_id": user_id}), 201
 
+    except HashingOverloaded as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -68,6 +73,8 @@ def login_user():
         print(f"Login successful for user {user.user_id}, tokens generated")
         return jsonify(response_data), 200
 
+    except HashingOverloaded as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -97,6 +104,62 @@ def refresh_token():
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 
+@router.route("/verify", methods=["POST"])
+def verify_token():
+    """Introspection: whether a token is valid and its user still active."""
+    try:
+        token = None
+        auth = request.headers.get("Authorization", "")
+        if auth.startswith("Bearer "):
+            token = auth[len("Bearer "):].strip()
+        else:
+            data = request.get_json(silent=True) or request.form
+            token = data.get("token")
+        if not token:
+            return jsonify({"error": "token is required"}), 400
+
+        claims = token_service.introspect(token)
+        if not claims:
+            return jsonify({"active": False}), 200
+
+        # Decoded claims are cached until exp; the user check is what makes
+        # a deactivated or deleted account's tokens inactive.
+        user = user_service.get_user_by_id(str(claims.get("sub", "")))
+        if not user or not user.is_active:
+            return jsonify({"active": False}), 200
+
+        return jsonify({
+            "active": True,
+            "sub": claims["sub"],
+            "username": claims.get("username"),
+            "token_type": claims.get("type"),
+            "exp": claims.get("exp"),
+            "iat": claims.get("iat"),
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+
+@well_known.route("/jwks.json", methods=["GET"])
+def get_jwks():
+    response = jsonify(token_service.jwks())
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response, 200
+
+
+@router.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    log_handler = get_rabbit_handler()
+    return jsonify({
+        **user_service.cache_stats(),
+        "tokens": token_service.decoded.stats(),
+        "password_hashing": user_service.hasher.stats(),
+        "outbox": user_service.outbox.stats() if user_service.outbox else None,
+        "log_publisher": log_handler.stats() if log_handler else None,
+    }), 200
+
+
 @router.route("/<user_id>", methods=["GET"])
 def get_user_by_id(user_id: str):
     try:
@@ -140,6 +203,8 @@ def update_user(user_id: str):
         result = user_service.update_user(user_id, user_data)
         return jsonify(result), 200
 
+    except HashingOverloaded as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
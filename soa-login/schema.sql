@@ -15,3 +15,90 @@ CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_users_is_active ON users(is_active);
 
 
+
+-- Side effects of user changes on other services (transactional outbox).
+-- Written in the same transaction as the change; soa-login's outbox worker
+-- delivers them with retries.
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGSERIAL PRIMARY KEY,
+    aggregate_id UUID NOT NULL,
+    event_type VARCHAR(100) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    idempotency_key UUID NOT NULL UNIQUE DEFAULT gen_random_uuid(),
+    correlation_id TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    delivered_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_events_pending ON outbox_events(next_attempt_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_outbox_events_aggregate ON outbox_events(aggregate_id, id) WHERE status = 'pending';
+
+CREATE OR REPLACE FUNCTION create_user_with_outbox(
+    p_username TEXT,
+    p_email TEXT,
+    p_password TEXT,
+    p_first_name TEXT,
+    p_last_name TEXT,
+    p_correlation_id TEXT
+) RETURNS SETOF users LANGUAGE plpgsql AS $$
+DECLARE
+    created users;
+BEGIN
+    INSERT INTO users (username, email, password, first_name, last_name)
+    VALUES (p_username, p_email, p_password, p_first_name, p_last_name)
+    RETURNING * INTO created;
+
+    INSERT INTO outbox_events (aggregate_id, event_type, payload, correlation_id)
+    VALUES (
+        created.id,
+        'expense.initialize',
+        jsonb_build_object('user_id', created.id, 'username', created.username),
+        p_correlation_id
+    );
+
+    RETURN NEXT created;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION delete_user_with_outbox(p_user_id UUID, p_correlation_id TEXT)
+RETURNS BOOLEAN LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM users WHERE id = p_user_id;
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+
+    INSERT INTO outbox_events (aggregate_id, event_type, correlation_id)
+    VALUES (p_user_id, 'expense.cleanup', p_correlation_id);
+    RETURN TRUE;
+END;
+$$;
+
+-- Leases up to p_limit due events by pushing next_attempt_at past the lease,
+-- skipping rows other workers hold and events queued behind an older pending
+-- event for the same user.
+CREATE OR REPLACE FUNCTION claim_outbox_events(p_limit INTEGER, p_lease_seconds INTEGER)
+RETURNS SETOF outbox_events LANGUAGE sql AS $$
+    UPDATE outbox_events
+    SET next_attempt_at = NOW() + make_interval(secs => p_lease_seconds)
+    WHERE id IN (
+        SELECT e.id
+        FROM outbox_events e
+        WHERE e.status = 'pending'
+          AND e.next_attempt_at <= NOW()
+          AND NOT EXISTS (
+              SELECT 1 FROM outbox_events earlier
+              WHERE earlier.aggregate_id = e.aggregate_id
+                AND earlier.status = 'pending'
+                AND earlier.id < e.id
+          )
+        ORDER BY e.id
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$;
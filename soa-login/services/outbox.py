@@ -0,0 +1,171 @@
+import logging
+import os
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import requests
+
+
+def outbox_config():
+    return {
+        "enabled": os.getenv("OUTBOX_WORKER_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "batch_size": int(os.getenv("OUTBOX_BATCH_SIZE", "20")),
+        "poll_interval": float(os.getenv("OUTBOX_POLL_INTERVAL", "2")),
+        "lease_seconds": int(os.getenv("OUTBOX_LEASE_SECONDS", "30")),
+        "max_attempts": int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12")),
+        "max_backoff": float(os.getenv("OUTBOX_MAX_BACKOFF", "300")),
+        "timeout": float(os.getenv("OUTBOX_HTTP_TIMEOUT", "5")),
+    }
+
+
+# Outcomes worth retrying; any other 4xx will not get better by itself.
+RETRYABLE_STATUSES = (408, 425, 429)
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Delivers `outbox_events` rows to soa-expense. Rows are written in the
+    same transaction as the user change that caused them (see schema.sql),
+    so a registration or deletion never loses its side effect, and the
+    request only waits for its own database write.
+
+    Rows are claimed with `claim_outbox_events`, which leases them for
+    `lease_seconds` (a crashed worker's claims come back) and holds back an
+    event while an older one for the same user is still pending, so a
+    cleanup never overtakes the initialize it undoes. Every attempt carries
+    the event's `Idempotency-Key`. Failures are retried with jittered
+    exponential backoff; after `max_attempts`, or on a non-retryable 4xx,
+    the event is marked dead and logged.
+    """
+
+    def __init__(
+        self,
+        db,
+        expense_service_url: str,
+        logger: logging.Logger,
+        batch_size: int = 20,
+        poll_interval: float = 2.0,
+        lease_seconds: int = 30,
+        max_attempts: int = 12,
+        max_backoff: float = 300.0,
+        timeout: float = 5.0,
+    ):
+        super().__init__(name="outbox-worker", daemon=True)
+        self.db = db
+        self.expense_service_url = expense_service_url
+        self.logger = logger
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+        self.last_error: Optional[str] = None
+
+    def _request(self, event: dict):
+        """(method, url, json) for an event."""
+        user_id = event["aggregate_id"]
+        if event["event_type"] == "expense.initialize":
+            return "POST", f"{self.expense_service_url}/users/{user_id}/initialize", event["payload"]
+        if event["event_type"] == "expense.cleanup":
+            return "DELETE", f"{self.expense_service_url}/users/{user_id}/expenses/expense/delete-all", None
+        raise ValueError(f"Unknown outbox event type {event['event_type']}")
+
+    def _deliver(self, event: dict):
+        """None when delivered, else (error, retryable)."""
+        try:
+            method, url, body = self._request(event)
+        except ValueError as exc:
+            return str(exc), False
+        headers = {"Idempotency-Key": str(event["idempotency_key"])}
+        if event.get("correlation_id"):
+            headers["X-Correlation-Id"] = event["correlation_id"]
+        try:
+            response = self._session.request(method, url, json=body, headers=headers, timeout=self.timeout)
+        except requests.RequestException as exc:
+            return str(exc), True
+        if response.status_code < 300:
+            return None
+        retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES
+        return f"{method} {url} -> {response.status_code}", retryable
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, 2.0 ** attempts)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _settle(self, event: dict, outcome):
+        now = datetime.now(timezone.utc)
+        attempts = event["attempts"] + 1
+        if outcome is None:
+            update = {"status": "delivered", "attempts": attempts, "delivered_at": now.isoformat(), "last_error": None}
+            self.delivered += 1
+        else:
+            error, retryable = outcome
+            self.last_error = error
+            update = {"attempts": attempts, "last_error": error[:1000]}
+            if retryable and attempts < self.max_attempts:
+                update["next_attempt_at"] = (now + timedelta(seconds=self._backoff(attempts))).isoformat()
+                self.retried += 1
+                level, message = logging.WARNING, "Outbox event delivery failed, will retry"
+            else:
+                update["status"] = "dead"
+                self.dead += 1
+                level, message = logging.ERROR, "Outbox event delivery gave up"
+            self.logger.log(
+                level,
+                message,
+                extra={
+                    "correlation_id": event.get("correlation_id"),
+                    "url": self.expense_service_url,
+                    "detail": f"event={event['id']} type={event['event_type']} attempt={attempts} {error}",
+                },
+            )
+        self.db.table("outbox_events").update(update).eq("id", event["id"]).execute()
+
+    def run_once(self) -> int:
+        """Claim and deliver one batch; the number of events handled."""
+        claimed = self.db.rpc(
+            "claim_outbox_events", {"p_limit": self.batch_size, "p_lease_seconds": self.lease_seconds}
+        ).execute()
+        events = claimed.data or []
+        for event in events:
+            self._settle(event, self._deliver(event))
+        return len(events)
+
+    def run(self):
+        while not self._stopping.is_set():
+            # Cleared before the poll, so a wake() during it is not lost.
+            self._wakeup.clear()
+            try:
+                handled = self.run_once()
+            except Exception as exc:
+                handled = 0
+                self.last_error = str(exc)
+                self.logger.warning("Outbox poll failed", extra={"detail": str(exc)})
+            if handled < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    def wake(self):
+        """Deliver newly written events now instead of at the next poll."""
+        self._wakeup.set()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dead": self.dead,
+            "last_error": self.last_error,
+        }
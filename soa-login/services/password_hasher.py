@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from logging_utils import span
+
+SCHEME = "scrypt"
+
+
+def hasher_config():
+    workers = os.getenv("PASSWORD_HASH_WORKERS", "")
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+    return {
+        "workers": workers,
+        "max_pending": int(os.getenv("PASSWORD_HASH_MAX_PENDING") or max(workers, 1) * 4),
+        "queue_timeout": float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "0.5")),
+        "timeout": float(os.getenv("PASSWORD_HASH_TIMEOUT", "10")),
+        "n": int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 14))),
+        "r": int(os.getenv("PASSWORD_SCRYPT_R", "8")),
+        "p": int(os.getenv("PASSWORD_SCRYPT_P", "1")),
+    }
+
+
+class HashingOverloaded(Exception):
+    """Too many password hashes are already queued; the request is shed."""
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # Runs in a pool process, off the interpreter serving requests.
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """
+    scrypt password hashes, stored as `scrypt$<n>$<r>$<p>$<salt>$<hash>`.
+    The KDF runs in a pool of `workers` processes (0 hashes on the calling
+    thread). At most `max_pending` hashes are queued or running; a caller
+    that cannot get a slot within `queue_timeout` seconds gets
+    `HashingOverloaded` rather than waiting behind the backlog.
+
+    Hashes from before scrypt (`<salt>:<sha256 hex>`) still verify, and
+    `needs_rehash` flags them for an upgrade at the next login.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        max_pending: int = 4,
+        queue_timeout: float = 0.5,
+        timeout: float = 10.0,
+        n: int = 2 ** 14,
+        r: int = 8,
+        p: int = 1,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.n, self.r, self.p = n, r, p
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool_lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.hashed = 0
+        self.shed = 0
+        self.in_flight = 0
+        if workers > 0:
+            self._pool = self._start_pool()
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        # Forked workers only ever run _scrypt, so the threads they are
+        # forked away from (the log publisher) do not matter to them; a
+        # spawned worker would re-run app.py instead. With "fork" every
+        # worker starts on the first submit, done here at startup.
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        pool.submit(int).result()
+        return pool
+
+    def _release(self, _future=None):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def _derive(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        with span("hash"):
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                self.shed += 1
+                raise HashingOverloaded("Password hashing is overloaded, try again later")
+            self.in_flight += 1
+            if self._pool is None:
+                try:
+                    return _scrypt(password, salt, n, r, p)
+                finally:
+                    self._release()
+            try:
+                future = self._pool.submit(_scrypt, password, salt, n, r, p)
+            except BrokenProcessPool:
+                self._release()
+                self._restart_pool()
+                raise
+            # The slot is held until the worker is done, even if we stop waiting.
+            future.add_done_callback(self._release)
+            try:
+                return future.result(timeout=self.timeout)
+            except BrokenProcessPool:
+                self._restart_pool()
+                raise
+
+    def _restart_pool(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, self._start_pool()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password: str) -> str:
+        salt = secrets.token_bytes(16)
+        digest = self._derive(password, salt, self.n, self.r, self.p)
+        self.hashed += 1
+        return f"{SCHEME}${self.n}${self.r}${self.p}${_b64(salt)}${_b64(digest)}"
+
+    def verify(self, password: str, stored: str) -> bool:
+        if stored.startswith(SCHEME + "$"):
+            _, n, r, p, salt, digest = stored.split("$")
+            derived = self._derive(password, _unb64(salt), int(n), int(r), int(p))
+            return hmac.compare_digest(derived, _unb64(digest))
+        salt, password_hash = stored.split(":")
+        with span("hash"):
+            legacy = hashlib.sha256((password + salt).encode()).hexdigest()
+        return hmac.compare_digest(legacy, password_hash)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """True for legacy SHA-256 hashes and scrypt hashes with other parameters."""
+        return not stored.startswith(f"{SCHEME}${self.n}${self.r}${self.p}$")
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "in_flight": self.in_flight,
+            "hashed": self.hashed,
+            "shed": self.shed,
+        }
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,65 @@
+import logging
+import os
+from typing import Dict, Optional
+from uuid import uuid4
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "EdDSA")
+_KEY_TYPES = {"RS256": rsa.RSAPrivateKey, "EdDSA": ed25519.Ed25519PrivateKey}
+
+
+class SigningKeys:
+    """
+    Private keys for one asymmetric algorithm, by key id. Keys are read from
+    `<keys_dir>/<kid>.pem`; tokens are signed with `active_kid`, or the
+    last kid in sort order, while every key stays in the JWKS so tokens
+    signed before a rotation still verify. Drop a retired key once the
+    longest-lived token it signed has expired. Without a directory a key is
+    generated for this process only.
+    """
+
+    def __init__(self, algorithm: str, keys_dir: str = "", active_kid: str = ""):
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"JWT_ALGORITHM must be HS256 or one of {ASYMMETRIC_ALGORITHMS}")
+        self.algorithm = algorithm
+        self._keys: Dict[str, object] = {}
+        if keys_dir:
+            for name in sorted(os.listdir(keys_dir)):
+                if not name.endswith(".pem"):
+                    continue
+                with open(os.path.join(keys_dir, name), "rb") as fh:
+                    key = serialization.load_pem_private_key(fh.read(), password=None)
+                if not isinstance(key, _KEY_TYPES[algorithm]):
+                    raise ValueError(f"{name} is not a {algorithm} private key")
+                self._keys[name[: -len(".pem")]] = key
+        if not self._keys:
+            logging.getLogger("soa-login").warning(
+                "No JWT signing keys in JWT_KEYS_DIR, using a key generated for this process"
+            )
+            key = rsa.generate_private_key(65537, 2048) if algorithm == "RS256" else ed25519.Ed25519PrivateKey.generate()
+            # A fresh kid per process, so verifiers holding the old key refetch.
+            self._keys[f"ephemeral-{uuid4().hex[:8]}"] = key
+        self.active_kid = active_kid or sorted(self._keys)[-1]
+        if self.active_kid not in self._keys:
+            raise ValueError(f"JWT_ACTIVE_KID {self.active_kid} has no key in JWT_KEYS_DIR")
+        self._jwks = {"keys": [self._jwk(kid, key) for kid, key in self._keys.items()]}
+
+    def _jwk(self, kid: str, key) -> dict:
+        exporter = RSAAlgorithm if self.algorithm == "RS256" else OKPAlgorithm
+        jwk = exporter.to_jwk(key.public_key(), as_dict=True)
+        jwk.update({"kid": kid, "alg": self.algorithm, "use": "sig"})
+        return jwk
+
+    @property
+    def signing_key(self):
+        return self._keys[self.active_kid]
+
+    def public_key(self, kid: Optional[str]):
+        key = self._keys.get(kid) if kid else None
+        return key.public_key() if key is not None else None
+
+    def jwks(self) -> dict:
+        return self._jwks
@@ -1,14 +1,93 @@
+import hashlib
 import jwt
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
+from logging_utils import span
+from services.signing_keys import SigningKeys
+
+
+class DecodedTokenCache:
+    """
+    Verified token claims keyed by a digest of the token, each kept until the
+    token's own `exp`, so repeated checks of one token skip the signature
+    verification. Least recently used entries go first past `size`.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._claims: "OrderedDict[bytes, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            claims = self._claims.get(key)
+            if claims is not None and claims["exp"] > time.time():
+                self._claims.move_to_end(key)
+                self.hits += 1
+                return claims
+            if claims is not None:
+                del self._claims[key]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, claims: dict):
+        if self.size <= 0 or "exp" not in claims:
+            return
+        with self._lock:
+            self._claims[self._key(token)] = claims
+            while len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._claims), "max_size": self.size, "hits": self.hits, "misses": self.misses}
+
 
 class TokenService:
     def __init__(self):
         self.secret_key = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
         self.access_token_expire_minutes = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
         self.refresh_token_expire_days = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
-        self.algorithm = "HS256"
+        # HS256 keeps the shared secret; RS256 or EdDSA sign with keys from
+        # JWT_KEYS_DIR that other services can fetch from the JWKS endpoint.
+        self.algorithm = os.getenv("JWT_ALGORITHM", "HS256")
+        self.keys = None
+        if self.algorithm != "HS256":
+            self.keys = SigningKeys(
+                self.algorithm, os.getenv("JWT_KEYS_DIR", ""), os.getenv("JWT_ACTIVE_KID", "")
+            )
+        self.decoded = DecodedTokenCache(int(os.getenv("TOKEN_CACHE_SIZE", "10000")))
+
+    def _encode(self, payload: dict) -> str:
+        with span("jwt"):
+            if self.keys is None:
+                return jwt.encode(payload, self.secret_key, algorithm=self.algorithm)
+            return jwt.encode(
+                payload, self.keys.signing_key, algorithm=self.algorithm, headers={"kid": self.keys.active_kid}
+            )
+
+    def _decode(self, token: str) -> dict:
+        with span("jwt"):
+            if self.keys is None:
+                return jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            key = self.keys.public_key(jwt.get_unverified_header(token).get("kid"))
+            if key is None:
+                raise jwt.InvalidTokenError("Unknown key id")
+            return jwt.decode(token, key, algorithms=[self.algorithm])
+
+    def jwks(self) -> dict:
+        """Public keys for local verification; empty with HS256, whose secret is never published."""
+        return self.keys.jwks() if self.keys is not None else {"keys": []}
 
     def create_access_token(self, user_id: str, username: str) -> str:
         now = datetime.now(timezone.utc)
@@ -20,7 +99,7 @@ class TokenService:
             "exp": int(exp.timestamp()),
             "iat": int(now.timestamp())
         }
-        return jwt.encode(payload, self.secret_key, algorithm=self.algorithm)
+        return self._encode(payload)
 
     def create_refresh_token(self, user_id: str, username: str) -> str:
         now = datetime.now(timezone.utc)
@@ -32,11 +111,11 @@ class TokenService:
             "exp": int(exp.timestamp()),
             "iat": int(now.timestamp())
         }
-        return jwt.encode(payload, self.secret_key, algorithm=self.algorithm)
+        return self._encode(payload)
 
     def verify_token(self, token: str, token_type: str = "access") -> Optional[Dict]:
         try:
-            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            payload = self._decode(token)
             if payload.get("type") != token_type:
                 return None
             return payload
@@ -45,6 +124,18 @@ class TokenService:
         except jwt.InvalidTokenError:
             return None
 
+    def introspect(self, token: str) -> Optional[Dict]:
+        """Claims of a valid token of any type, cached until it expires; None when invalid."""
+        claims = self.decoded.get(token)
+        if claims is not None:
+            return claims
+        try:
+            claims = self._decode(token)
+        except jwt.InvalidTokenError:
+            return None
+        self.decoded.put(token, claims)
+        return claims
+
     def refresh_access_token(self, refresh_token: str) -> Optional[str]:
         payload = self.verify_token(refresh_token, "refresh")
         if not payload:
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from uuid import uuid4
+
+
+def cache_config():
+    return {
+        "size": int(os.getenv("USER_CACHE_SIZE", "10000")),
+        "ttl": float(os.getenv("USER_CACHE_TTL", "30")),
+        "invalidation": os.getenv("USER_CACHE_INVALIDATION", "true").lower() in ("1", "true", "yes"),
+        "exchange": os.getenv("USER_CACHE_EXCHANGE", "user-cache-invalidation"),
+    }
+
+
+class UserCache:
+    """
+    In-process LRU cache of `users` rows with a time-to-live, reachable by id
+    and by username. Rows are stored as Supabase returned them; logins read
+    the database instead and refresh the row. `size` bounds the number of
+    users; a row older than `ttl` seconds is a miss. A `size` of 0 disables
+    the cache.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 30.0):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user id -> (expires at, row), least recently used first
+        self._rows: "OrderedDict[str, tuple]" = OrderedDict()
+        self._ids_by_username = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Bumped by every invalidation; a row read from the database before
+        # the bump may be stale and is not cached.
+        self.generation = 0
+        # Called with the user id (None for everything) after a local invalidation.
+        self.on_invalidate: Optional[Callable[[Optional[str]], None]] = None
+
+    def _get(self, user_id: Optional[str]) -> Optional[dict]:
+        entry = self._rows.get(user_id) if user_id is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(user_id)
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def get_by_id(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._get(str(user_id))
+
+    def get_by_username(self, username: str) -> Optional[dict]:
+        with self._lock:
+            return self._get(self._ids_by_username.get(username))
+
+    def put(self, row: dict, generation: Optional[int] = None):
+        """Cache `row`; pass the `generation` seen before reading it to skip rows that raced a write."""
+        if self.size <= 0:
+            return
+        user_id = str(row["id"])
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(user_id)
+            self._rows[user_id] = (time.monotonic() + self.ttl, row)
+            self._ids_by_username[row["username"]] = user_id
+            while len(self._rows) > self.size:
+                self._remove(next(iter(self._rows)))
+                self.evictions += 1
+
+    def _remove(self, user_id: str):
+        entry = self._rows.pop(user_id, None)
+        if entry is not None and self._ids_by_username.get(entry[1]["username"]) == user_id:
+            del self._ids_by_username[entry[1]["username"]]
+
+    def discard(self, user_id: Optional[str] = None):
+        """Drop one user, or every user when `user_id` is None, without notifying peers."""
+        with self._lock:
+            if user_id is None:
+                self._rows.clear()
+                self._ids_by_username.clear()
+            else:
+                self._remove(str(user_id))
+            self.generation += 1
+            self.invalidations += 1
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drop one user (or all of them) here and in every process listening for it."""
+        self.discard(user_id)
+        if self.on_invalidate is not None:
+            self.on_invalidate(user_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "max_size": self.size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class CacheInvalidationChannel:
+    """
+    Fans invalidations out to the other soa-login processes over a RabbitMQ
+    fanout exchange, on the connection the log handler already holds. Each
+    process listens on its own exclusive queue and skips its own messages.
+    While the connection is down, messages can be missed, so the cache is
+    cleared whenever it (re)subscribes.
+    """
+
+    def __init__(self, cache: UserCache, handler, exchange: str):
+        self.cache = cache
+        self.handler = handler
+        self.exchange = exchange
+        self.origin = uuid4().hex
+        self.sent = 0
+        self.received = 0
+        cache.on_invalidate = self.publish
+        handler.subscribe(exchange, self._on_message, on_subscribed=lambda: cache.discard())
+
+    def publish(self, user_id: Optional[str]):
+        body = json.dumps({"origin": self.origin, "user_id": user_id}).encode("utf-8")
+        if self.handler.broadcast(self.exchange, body):
+            self.sent += 1
+
+    def _on_message(self, body: bytes):
+        message = json.loads(body)
+        if message.get("origin") == self.origin:
+            return
+        self.received += 1
+        self.cache.discard(message.get("user_id"))
+
+    def stats(self) -> dict:
+        return {"exchange": self.exchange, "sent": self.sent, "received": self.received}
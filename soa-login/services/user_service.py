@@ -1,13 +1,13 @@
-import hashlib
 import logging
-import secrets
 from datetime import datetime
 from typing import Optional, List
 from db.supabase import get_db
 from models.user_model import UserCreate, UserUpdate, UserResponse
-import requests
 import os
-from logging_utils import get_correlation_id, get_logger
+from logging_utils import get_correlation_id, get_logger, get_rabbit_handler, span
+from services.outbox import OutboxWorker, outbox_config
+from services.password_hasher import HashingOverloaded, PasswordHasher, hasher_config
+from services.user_cache import CacheInvalidationChannel, UserCache, cache_config
 
 
 class UserService:
@@ -15,65 +15,121 @@ class UserService:
         self.logger = get_logger() or logging.getLogger("soa-login")
         self.db = get_db()
         self.expense_service_url = os.getenv("EXPENSE_SERVICE_URL", "http://localhost:8000")
+        cache_cfg = cache_config()
+        self.cache = UserCache(cache_cfg["size"], cache_cfg["ttl"])
+        self.cache_channel = None
+        handler = get_rabbit_handler()
+        if cache_cfg["invalidation"] and handler is not None:
+            self.cache_channel = CacheInvalidationChannel(self.cache, handler, cache_cfg["exchange"])
+        self.hasher = PasswordHasher(**hasher_config())
+        # Started after the hasher, whose pool is forked without this thread.
+        outbox_cfg = outbox_config()
+        self.outbox = None
+        if outbox_cfg.pop("enabled"):
+            self.outbox = OutboxWorker(self.db, self.expense_service_url, self.logger, **outbox_cfg)
+            self.outbox.start()
+
+    @staticmethod
+    def _execute(query):
+        with span("db"):
+            return query.execute()
 
     def _hash_password(self, password: str) -> str:
-        salt = secrets.token_hex(16)
-        password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-        return f"{salt}:{password_hash}"
+        return self.hasher.hash(password)
 
     def _verify_password(self, password: str, hashed_password: str) -> bool:
-        salt, password_hash = hashed_password.split(":")
-        return hashlib.sha256((password + salt).encode()).hexdigest() == password_hash
+        return self.hasher.verify(password, hashed_password)
+
+    def _upgrade_password_hash(self, user_doc: dict, password: str):
+        """Re-hash a legacy (or outdated scrypt) hash now that the password is known."""
+        try:
+            self._execute(
+                self.db.table("users")
+                .update({"password": self._hash_password(password)})
+                .eq("id", user_doc["id"])
+                .eq("password", user_doc["password"])
+            )
+            self.cache.invalidate(str(user_doc["id"]))
+        except Exception as exc:
+            # The login itself succeeded; the upgrade is retried next time.
+            self.logger.warning(
+                "Failed to upgrade password hash",
+                extra={
+                    "correlation_id": get_correlation_id(),
+                    "path": "/users/login",
+                    "detail": f"user_id={user_doc['id']} {exc}",
+                },
+            )
+
+    @staticmethod
+    def _to_response(user_doc: dict) -> UserResponse:
+        created_at = user_doc["created_at"]
+        updated_at = user_doc["updated_at"]
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+        if isinstance(updated_at, str):
+            updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
+        return UserResponse(
+            user_id=str(user_doc["id"]),
+            username=user_doc["username"],
+            email=user_doc["email"],
+            first_name=user_doc.get("first_name"),
+            last_name=user_doc.get("last_name"),
+            created_at=created_at,
+            updated_at=updated_at,
+            is_active=user_doc.get("is_active", True),
+        )
+
+    def _fetch_user(self, column: str, value: str, fresh: bool = False) -> Optional[dict]:
+        """
+        The `users` row whose `column` ("id" or "username") is `value`, from
+        the cache if possible. `fresh` reads the database and refreshes the cache.
+        """
+        if not fresh:
+            user_doc = self.cache.get_by_id(value) if column == "id" else self.cache.get_by_username(value)
+            if user_doc is not None:
+                return user_doc
+        generation = self.cache.generation
+        result = self._execute(self.db.table("users").select("*").eq(column, value))
+        if not result.data:
+            return None
+        user_doc = result.data[0]
+        self.cache.put(user_doc, generation)
+        return user_doc
+
+    def cache_stats(self) -> dict:
+        stats = self.cache.stats()
+        if self.cache_channel is not None:
+            stats["invalidation"] = self.cache_channel.stats()
+        return stats
 
     def create_user(self, user_data: UserCreate) -> str:
-        existing_username = self.db.table("users").select("id").eq("username", user_data.username).execute()
+        existing_username = self._execute(self.db.table("users").select("id").eq("username", user_data.username))
         if existing_username.data:
             raise ValueError("Username already exists")
 
-        existing_email = self.db.table("users").select("id").eq("email", user_data.email).execute()
+        existing_email = self._execute(self.db.table("users").select("id").eq("email", user_data.email))
         if existing_email.data:
             raise ValueError("Email already exists")
 
         hashed_password = self._hash_password(user_data.password)
 
-        user_doc = {
-            "username": user_data.username,
-            "email": user_data.email,
-            "password": hashed_password,
-            "first_name": user_data.first_name,
-            "last_name": user_data.last_name,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "is_active": True,
-        }
-
-        result = self.db.table("users").insert(user_doc).execute()
+        # The user and its expense-profile event commit together; the outbox
+        # worker calls soa-expense after the response.
+        result = self._execute(self.db.rpc("create_user_with_outbox", {
+            "p_username": user_data.username,
+            "p_email": user_data.email,
+            "p_password": hashed_password,
+            "p_first_name": user_data.first_name,
+            "p_last_name": user_data.last_name,
+            "p_correlation_id": get_correlation_id(),
+        }))
         if not result.data:
             raise ValueError("Failed to create user")
-        
-        user_id = result.data[0]["id"]
 
-        headers = {}
-        cid = get_correlation_id()
-        if cid:
-            headers["X-Correlation-Id"] = cid
-        try:
-            requests.post(
-                f"{self.expense_service_url}/users/{user_id}/initialize",
-                json={"user_id": user_id, "username": user_data.username},
-                headers=headers,
-                timeout=2,
-            )
-        except requests.RequestException as exc:
-            self.logger.warning(
-                "Failed to initialize expense profile",
-                extra={
-                    "correlation_id": cid,
-                    "url": f"{self.expense_service_url}/users/{user_id}/initialize",
-                    "method": "POST",
-                    "detail": str(exc),
-                },
-            )
+        user_id = result.data[0]["id"]
+        if self.outbox is not None:
+            self.outbox.wake()
 
         self.logger.info(
             "User created",
@@ -87,57 +143,21 @@ class UserService:
 
     def get_user_by_id(self, user_id: str) -> Optional[UserResponse]:
         try:
-            result = self.db.table("users").select("*").eq("id", user_id).execute()
-            if not result.data:
+            user_doc = self._fetch_user("id", user_id)
+            if user_doc is None:
                 return None
-
-            user_doc = result.data[0]
-            created_at = user_doc["created_at"]
-            updated_at = user_doc["updated_at"]
-            if isinstance(created_at, str):
-                created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-            if isinstance(updated_at, str):
-                updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
-            
-            return UserResponse(
-                user_id=str(user_doc["id"]),
-                username=user_doc["username"],
-                email=user_doc["email"],
-                first_name=user_doc.get("first_name"),
-                last_name=user_doc.get("last_name"),
-                created_at=created_at,
-                updated_at=updated_at,
-                is_active=user_doc.get("is_active", True),
-            )
+            return self._to_response(user_doc)
         except Exception:
             return None
 
     def get_user_by_username(self, username: str) -> Optional[UserResponse]:
-        result = self.db.table("users").select("*").eq("username", username).execute()
-        if not result.data:
+        user_doc = self._fetch_user("username", username)
+        if user_doc is None:
             return None
-
-        user_doc = result.data[0]
-        created_at = user_doc["created_at"]
-        updated_at = user_doc["updated_at"]
-        if isinstance(created_at, str):
-            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-        if isinstance(updated_at, str):
-            updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
-        
-        return UserResponse(
-            user_id=str(user_doc["id"]),
-            username=user_doc["username"],
-            email=user_doc["email"],
-            first_name=user_doc.get("first_name"),
-            last_name=user_doc.get("last_name"),
-            created_at=created_at,
-            updated_at=updated_at,
-            is_active=user_doc.get("is_active", True),
-        )
+        return self._to_response(user_doc)
 
     def get_all_users(self, skip: int = 0, limit: int = 100) -> List[UserResponse]:
-        result = self.db.table("users").select("*").range(skip, skip + limit - 1).execute()
+        result = self._execute(self.db.table("users").select("*").range(skip, skip + limit - 1))
         
         users = []
         for user_doc in result.data:
@@ -163,35 +183,22 @@ class UserService:
         return users
 
     def login_user(self, username: str, password: str) -> Optional[UserResponse]:
-        result = self.db.table("users").select("*").eq("username", username).execute()
-        if not result.data:
+        # Read fresh: another worker may have deactivated the user or changed
+        # the password since this worker cached the row.
+        user_doc = self._fetch_user("username", username, fresh=True)
+        if user_doc is None:
             return None
 
-        user_doc = result.data[0]
-
         if not user_doc.get("is_active", True):
             raise ValueError("User account is inactive")
 
         if not self._verify_password(password, user_doc["password"]):
             return None
 
-        created_at = user_doc["created_at"]
-        updated_at = user_doc["updated_at"]
-        if isinstance(created_at, str):
-            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-        if isinstance(updated_at, str):
-            updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
+        if self.hasher.needs_rehash(user_doc["password"]):
+            self._upgrade_password_hash(user_doc, password)
 
-        user = UserResponse(
-            user_id=str(user_doc["id"]),
-            username=user_doc["username"],
-            email=user_doc["email"],
-            first_name=user_doc.get("first_name"),
-            last_name=user_doc.get("last_name"),
-            created_at=created_at,
-            updated_at=updated_at,
-            is_active=user_doc.get("is_active", True),
-        )
+        user = self._to_response(user_doc)
         self.logger.info(
             "User login success",
             extra={
@@ -204,20 +211,20 @@ class UserService:
 
     def update_user(self, user_id: str, user_data: UserUpdate) -> dict:
         try:
-            existing = self.db.table("users").select("id").eq("id", user_id).execute()
+            existing = self._execute(self.db.table("users").select("id").eq("id", user_id))
             if not existing.data:
                 raise ValueError(f"User with id {user_id} not found")
 
             update_data = {"updated_at": datetime.now().isoformat()}
 
             if user_data.username is not None:
-                username_check = self.db.table("users").select("id").eq("username", user_data.username).execute()
+                username_check = self._execute(self.db.table("users").select("id").eq("username", user_data.username))
                 if username_check.data and str(username_check.data[0]["id"]) != user_id:
                     raise ValueError("Username already exists")
                 update_data["username"] = user_data.username
 
             if user_data.email is not None:
-                email_check = self.db.table("users").select("id").eq("email", user_data.email).execute()
+                email_check = self._execute(self.db.table("users").select("id").eq("email", user_data.email))
                 if email_check.data and str(email_check.data[0]["id"]) != user_id:
                     raise ValueError("Email already exists")
                 update_data["email"] = user_data.email
@@ -231,7 +238,8 @@ class UserService:
             if user_data.password is not None:
                 update_data["password"] = self._hash_password(user_data.password)
 
-            self.db.table("users").update(update_data).eq("id", user_id).execute()
+            self._execute(self.db.table("users").update(update_data).eq("id", user_id))
+            self.cache.invalidate(user_id)
             self.logger.info(
                 "User updated",
                 extra={
@@ -243,20 +251,21 @@ class UserService:
             return {"message": "User updated successfully"}
 
         except Exception as e:
-            if isinstance(e, ValueError):
+            if isinstance(e, (ValueError, HashingOverloaded)):
                 raise
             raise ValueError(f"Error updating user: {str(e)}")
 
     def update_user_status(self, user_id: str, is_active: bool) -> dict:
         try:
-            existing = self.db.table("users").select("id").eq("id", user_id).execute()
+            existing = self._execute(self.db.table("users").select("id").eq("id", user_id))
             if not existing.data:
                 raise ValueError(f"User with id {user_id} not found")
 
-            self.db.table("users").update({
+            self._execute(self.db.table("users").update({
                 "is_active": is_active,
                 "updated_at": datetime.now().isoformat()
-            }).eq("id", user_id).execute()
+            }).eq("id", user_id))
+            self.cache.invalidate(user_id)
             self.logger.info(
                 "User status updated",
                 extra={
@@ -275,32 +284,21 @@ class UserService:
 
     def delete_user(self, user_id: str) -> dict:
         try:
-            existing = self.db.table("users").select("id").eq("id", user_id).execute()
+            existing = self._execute(self.db.table("users").select("id").eq("id", user_id))
             if not existing.data:
                 raise ValueError(f"User with id {user_id} not found")
 
-            self.db.table("users").delete().eq("id", user_id).execute()
-
-            headers = {}
-            cid = get_correlation_id()
-            if cid:
-                headers["X-Correlation-Id"] = cid
-            try:
-                requests.delete(
-                    f"{self.expense_service_url}/users/{user_id}/expenses/expense/delete-all",
-                    headers=headers,
-                    timeout=2,
-                )
-            except requests.RequestException as exc:
-                self.logger.warning(
-                    "Failed to cleanup expenses on user delete",
-                    extra={
-                        "correlation_id": cid,
-                        "url": f"{self.expense_service_url}/users/{user_id}/expenses/expense/delete-all",
-                        "method": "DELETE",
-                        "detail": str(exc),
-                    },
-                )
+            # Deletes the user and records the expense cleanup in one transaction.
+            deleted = self._execute(self.db.rpc("delete_user_with_outbox", {
+                "p_user_id": user_id,
+                "p_correlation_id": get_correlation_id(),
+            }))
+            if not deleted.data:
+                # Another request deleted the user after the check above.
+                raise ValueError(f"User with id {user_id} not found")
+            self.cache.invalidate(user_id)
+            if self.outbox is not None:
+                self.outbox.wake()
 
             self.logger.info(
                 "User deleted",
@@ -319,12 +317,13 @@ class UserService:
             raise ValueError(f"Error deleting user: {str(e)}")
 
     def delete_all_users(self) -> dict:
-        all_users = self.db.table("users").select("id").execute()
+        all_users = self._execute(self.db.table("users").select("id"))
         count = len(all_users.data) if all_users.data else 0
         
         if count > 0:
             for user in all_users.data:
-                self.db.table("users").delete().eq("id", user["id"]).execute()
+                self._execute(self.db.table("users").delete().eq("id", user["id"]))
+        self.cache.invalidate()
         self.logger.info(
             "All users deleted",
             extra={
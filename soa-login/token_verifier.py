@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Sequence
+
+import jwt
+import requests
+
+logger = logging.getLogger("soa-login.token-verifier")
+
+
+class TokenVerifier:
+    """
+    Verifies soa-login tokens locally against its JWKS, for services that
+    would otherwise call back into soa-login on every request. Depends only
+    on PyJWT (with cryptography) and requests, so it can be copied as is.
+
+    Keys are fetched once and kept for `cache_ttl` seconds. A token with an
+    unknown key id (soa-login rotated its key) triggers an early refetch, at
+    most once every `min_refresh_interval` seconds. When soa-login cannot be
+    reached, the keys already known keep being used.
+
+        verifier = TokenVerifier("http://soa-login:8001/.well-known/jwks.json")
+        claims = verifier.verify(token)  # None when invalid or expired
+
+    This does not see deactivated users; use POST /users/verify for that.
+    """
+
+    def __init__(
+        self,
+        jwks_url: str,
+        algorithms: Sequence[str] = ("RS256", "EdDSA"),
+        cache_ttl: float = 300.0,
+        min_refresh_interval: float = 30.0,
+        timeout: float = 2.0,
+        leeway: float = 0.0,
+    ):
+        self.jwks_url = jwks_url
+        self.algorithms = tuple(algorithms)
+        self.cache_ttl = cache_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.leeway = leeway
+        self._lock = threading.Lock()
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._fetched_at = 0.0
+        self._attempted_at = float("-inf")
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _refresh(self):
+        self._attempted_at = time.monotonic()
+        try:
+            response = requests.get(self.jwks_url, timeout=self.timeout)
+            response.raise_for_status()
+            keys = {}
+            for data in response.json().get("keys", []):
+                if data.get("kid") and data.get("alg") in self.algorithms:
+                    keys[data["kid"]] = jwt.PyJWK.from_dict(data)
+        except (requests.RequestException, ValueError, jwt.PyJWKError) as exc:
+            self.refresh_errors += 1
+            logger.warning("Failed to fetch JWKS from %s: %s", self.jwks_url, exc)
+            return
+        self._keys = keys
+        self._fetched_at = self._attempted_at
+        self.refreshes += 1
+
+    def _key(self, kid: Optional[str]) -> Optional[jwt.PyJWK]:
+        with self._lock:
+            now = time.monotonic()
+            retry_due = now - self._attempted_at >= self.min_refresh_interval
+            expired = now - self._fetched_at >= self.cache_ttl
+            if retry_due and (expired or kid not in self._keys):
+                self._refresh()
+            return self._keys.get(kid)
+
+    def verify(self, token: str, token_type: Optional[str] = "access") -> Optional[dict]:
+        """The token's claims if its signature, expiry and (unless None) type check out."""
+        try:
+            header = jwt.get_unverified_header(token)
+            if header.get("alg") not in self.algorithms:
+                return None
+            key = self._key(header.get("kid"))
+            if key is None:
+                return None
+            claims = jwt.decode(token, key.key, algorithms=[key.algorithm_name], leeway=self.leeway)
+        except jwt.InvalidTokenError:
+            return None
+        if token_type is not None and claims.get("type") != token_type:
+            return None
+        return claims
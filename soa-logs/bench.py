@@ -0,0 +1,435 @@
+"""
+Ingest and query benchmark for soa-logs.
+
+Synthetic payloads shaped like `RabbitMQHandler.emit` are fed through the
+real consumer, writer and read paths of `server`, with an in-process stand-in
+for the RabbitMQ connection and a fresh temporary SQLite file per size.
+Results go to stdout (or --out) as JSON so runs can be compared between
+commits; progress goes to stderr.
+
+    python bench.py --sizes 100000,1000000,10000000 --out bench.json
+
+10M rows takes a while and several GB of disk.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("LOG_RETENTION_DAYS", "0")
+
+import pika  # noqa: E402
+
+import server  # noqa: E402
+from storage import DAY_US, from_epoch_us, to_epoch_us  # noqa: E402
+from tail import TailBuffer  # noqa: E402
+
+BASE_TIME = datetime(2026, 1, 1, tzinfo=timezone.utc)
+SERVICES = ("soa-login", "soa-expense", "soa-category-budget", "soa-analytics", "soa-subscription")
+ROUTES = (
+    ("GET", "/users/{id}"),
+    ("POST", "/users/login"),
+    ("POST", "/users/refresh"),
+    ("GET", "/expenses/{id}"),
+    ("POST", "/expenses"),
+    ("GET", "/budgets/{id}/summary"),
+    ("DELETE", "/users/{id}"),
+)
+MESSAGES = (
+    ("INFO", "User logged in"),
+    ("INFO", "Token refreshed"),
+    ("DEBUG", "Cache miss for user"),
+    ("WARNING", "Invalid token"),
+    ("ERROR", "Expense service call failed: timeout"),
+)
+TEMPLATE_POOL = 4096
+HOPS_PER_TRACE = 3
+
+
+def _log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+class Payloads:
+    """
+    Deterministic stream of emit-shaped bodies. A pool of rendered templates
+    keeps generation cheap next to ingest; each body gets its own timestamp,
+    spread evenly over `days`, and every few consecutive bodies share a
+    correlation id like the hops of one request.
+    """
+
+    def __init__(self, rows: int, days: int, seed: int):
+        self.rows = rows
+        self.seed = seed
+        self.step_us = days * DAY_US // rows
+        rng = random.Random(seed)
+        self.templates = [self._render(rng) for _ in range(TEMPLATE_POOL)]
+
+    @staticmethod
+    def _render(rng: random.Random) -> bytes:
+        service = rng.choice(SERVICES)
+        if rng.random() < 0.8:
+            method, route = rng.choice(ROUTES)
+            url = "http://%s:8000%s" % (service, route.replace("{id}", str(rng.randint(1, 50000))))
+            status = rng.choices((200, 201, 400, 401, 404, 500), (70, 10, 5, 5, 5, 5))[0]
+            level, message = ("ERROR" if status >= 500 else "INFO"), "Request handled"
+            detail = "%.2fms" % rng.lognormvariate(2.5, 0.8)
+        else:
+            method, url, status, detail = "", "", None, None
+            level, message = rng.choice(MESSAGES)
+        payload = {
+            "timestamp": "@@TS@@",
+            "level": level,
+            "message": message,
+            "service": service,
+            "correlation_id": "@@CID@@",
+            "url": url,
+            "method": method,
+            "status_code": status,
+            "detail": detail,
+        }
+        payload["formatted"] = f"@@TS@@ {level} {url} Correlation:@@CID@@ [{service}] - {message}"
+        return json.dumps(payload).encode("utf-8")
+
+    def correlation_id(self, index: int) -> str:
+        return "%08x-0000-4000-8000-%012x" % (self.seed, index // HOPS_PER_TRACE)
+
+    def timestamp(self, index: int) -> datetime:
+        return BASE_TIME + timedelta(microseconds=index * self.step_us)
+
+    def body(self, index: int) -> bytes:
+        body = self.templates[index % TEMPLATE_POOL]
+        body = body.replace(b"@@TS@@", self.timestamp(index).isoformat().encode())
+        return body.replace(b"@@CID@@", self.correlation_id(index).encode())
+
+    def bodies(self, start: int, count: int):
+        return (self.body(i) for i in range(start, start + count))
+
+
+class StandInBroker:
+    """
+    One in-memory queue with lazily generated messages. Implements the parts
+    of `pika.BlockingConnection` that `LogConsumer` and `pull_logs` use,
+    including prefetch limits and `multiple=True` acks.
+    """
+
+    def __init__(self):
+        self._sources: deque = deque()
+        self.remaining = 0
+        self.acked = 0
+        self.nacked = 0
+        self._lock = threading.Lock()
+
+    def publish(self, bodies, count: int):
+        with self._lock:
+            self._sources.append(iter(bodies))
+            self.remaining += count
+
+    def take(self):
+        with self._lock:
+            while self._sources:
+                body = next(self._sources[0], None)
+                if body is not None:
+                    self.remaining -= 1
+                    return body
+                self._sources.popleft()
+        return None
+
+    def connect(self, params=None):
+        return _StandInConnection(self)
+
+
+class _StandInChannel:
+    def __init__(self, broker: StandInBroker):
+        self.broker = broker
+        self.is_open = True
+        self.prefetch = 0
+        self.on_message = None
+        self.delivered = 0
+        self.settled = 0
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def queue_bind(self, **kwargs):
+        pass
+
+    def queue_declare(self, queue, durable=True, passive=False):
+        return SimpleNamespace(method=SimpleNamespace(message_count=self.broker.remaining))
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.on_message = on_message_callback
+        return "bench"
+
+    def basic_cancel(self, consumer_tag):
+        self.on_message = None
+
+    def basic_get(self, queue, auto_ack=False):
+        body = self.broker.take()
+        if body is None:
+            return None, None, None
+        self.delivered += 1
+        return SimpleNamespace(delivery_tag=self.delivered, redelivered=False), SimpleNamespace(), body
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.broker.acked += delivery_tag - self.settled if multiple else 1
+        self.settled = delivery_tag
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.broker.nacked += delivery_tag - self.settled if multiple else 1
+        self.settled = delivery_tag
+
+    def deliver(self) -> int:
+        count = 0
+        while self.on_message and self.delivered - self.settled < self.prefetch:
+            body = self.broker.take()
+            if body is None:
+                break
+            self.delivered += 1
+            count += 1
+            self.on_message(self, SimpleNamespace(delivery_tag=self.delivered, redelivered=False), SimpleNamespace(), body)
+        return count
+
+
+class _StandInConnection:
+    def __init__(self, broker: StandInBroker):
+        self._channel = _StandInChannel(broker)
+        self._callbacks: deque = deque()
+        self.is_open = True
+
+    def channel(self):
+        return self._channel
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        ran = 0
+        while self._callbacks:
+            self._callbacks.popleft()()
+            ran += 1
+        if not self._channel.deliver() and not ran:
+            time.sleep(min(time_limit, 0.005))
+
+    def close(self):
+        self.is_open = False
+        self._channel.is_open = False
+
+
+def _percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": pick(0.50),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+async def _drain_stream(response):
+    async for _ in response.body_iterator:
+        pass
+
+
+def _query_cases(payloads: Payloads, rng: random.Random):
+    """Each case calls the endpoint function itself, minus HTTP."""
+    span_us = payloads.rows * payloads.step_us
+    base_ts = to_epoch_us(BASE_TIME)
+
+    def window(width_us: int):
+        start = base_ts + rng.randrange(max(span_us - width_us, 1))
+        return from_epoch_us(start).isoformat(), from_epoch_us(start + width_us).isoformat()
+
+    def search(**kwargs):
+        start, end = window(DAY_US)
+        params = dict(
+            service=None, level=None, url=None, method=None, status_code=None,
+            correlation_id=None, q=None, limit=100, cursor=None, raw=True,
+        )
+        params.update(kwargs)
+        return server.search_logs(start, end, **params)
+
+    def range_page():
+        start, end = window(span_us // 4)
+        return server.get_logs_between(start, end, limit=100, cursor=None, format="json", raw=True)
+
+    async def range_stream_minute():
+        start, end = window(60_000_000)
+        response = await server.get_logs_between(start, end, limit=None, cursor=None, format="ndjson", raw=False)
+        await _drain_stream(response)
+
+    def search_filters():
+        return search(service=rng.choice(SERVICES), status_code=500)
+
+    def search_text():
+        return search(q="timeout")
+
+    def trace():
+        cid = payloads.correlation_id(rng.randrange(payloads.rows))
+        return server.trace_logs(cid, start=None, end=None, raw=False)
+
+    def rollups():
+        start, end = window(DAY_US)
+        return server.get_rollups(start, end, service=None, path=None, interval=60)
+
+    def aggregate():
+        start, end = window(DAY_US)
+        return server.aggregate_logs(
+            start, end, by="service,path", service=None, level=None, method=None, requests_only=True
+        )
+
+    return {
+        "range_page": range_page,
+        "range_stream_minute": range_stream_minute,
+        "search_filters": search_filters,
+        "search_text": search_text,
+        "trace": trace,
+        "rollups": rollups,
+        "aggregate": aggregate,
+    }
+
+
+async def run_size(rows: int, args, broker: StandInBroker) -> dict:
+    workdir = tempfile.mkdtemp(prefix="soa-logs-bench-", dir=args.tmpdir)
+    server.DB_PATH = os.path.join(workdir, "logs.db")
+    server.ARCHIVE_DIR = os.path.join(workdir, "archive")
+    server.SHARD_COUNT = args.shards
+    server.tail = TailBuffer(server.TAIL_BUFFER_SIZE)
+    server.CONSUMER_ENABLED = True
+    payloads = Payloads(rows, args.days, args.seed)
+    result = {"rows": rows}
+
+    try:
+        server.on_startup()
+        _log(f"[{rows}] ingesting through the consumer")
+        started = time.perf_counter()
+        broker.publish(payloads.bodies(0, rows), rows)
+        while sum(shard.writer.committed_rows for shard in server.shards) < rows:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        result["ingest"] = {"rows": rows, "seconds": round(elapsed, 3), "rows_per_sec": round(rows / elapsed)}
+
+        server.consumer.stop()
+        server.consumer = None
+        pulled = min(args.pull_rows, rows)
+        _log(f"[{rows}] draining {pulled} rows with pull_logs")
+        broker.publish(payloads.bodies(rows, pulled), pulled)
+        started = time.perf_counter()
+        await asyncio.to_thread(server.pull_logs)
+        elapsed = time.perf_counter() - started
+        result["pull"] = {"rows": pulled, "seconds": round(elapsed, 3), "rows_per_sec": round(pulled / elapsed)}
+
+        _log(f"[{rows}] running queries")
+        rng = random.Random(args.seed)
+        queries = {}
+        for name, case in _query_cases(payloads, rng).items():
+            samples = []
+            for _ in range(args.queries):
+                started = time.perf_counter()
+                await case()
+                samples.append(time.perf_counter() - started)
+            queries[name] = _percentiles(samples)
+        result["queries"] = queries
+        result["db_bytes"] = sum(
+            os.path.getsize(path)
+            for shard in server.shards
+            for path in (shard.store.db_path, shard.store.db_path + "-wal")
+            if os.path.exists(path)
+        )
+    finally:
+        server.on_shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def main(args):
+    broker = StandInBroker()
+    pika.BlockingConnection = broker.connect
+    results = []
+    for rows in args.sizes:
+        results.append(await run_size(rows, args, broker))
+        _log(json.dumps(results[-1]))
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+            "days": args.days,
+            "queries_per_case": args.queries,
+            "settings": {
+                "consumer_prefetch": server.CONSUMER_PREFETCH,
+                "consumer_batch_size": server.CONSUMER_BATCH_SIZE,
+                "writer_batch_size": server.WRITER_BATCH_SIZE,
+                "db_synchronous": server.DB_SYNCHRONOUS,
+                "read_pool_size": server.READ_POOL_SIZE,
+                "shards": args.shards,
+                "shard_key": server.SHARD_KEY,
+            },
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[100_000, 1_000_000, 10_000_000],
+        help="comma-separated row counts (default: 100000,1000000,10000000)",
+    )
+    parser.add_argument("--shards", type=int, default=server.SHARD_COUNT, help="number of shard databases")
+    parser.add_argument("--queries", type=int, default=200, help="runs per query case")
+    parser.add_argument("--pull-rows", type=int, default=50_000, help="rows drained through pull_logs")
+    parser.add_argument("--days", type=int, default=7, help="days the synthetic timestamps span")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tmpdir", default=None, help="where to create the temporary databases")
+    parser.add_argument("--out", default=None, help="write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,92 @@
+import zlib
+from typing import AsyncIterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Cap on how much one compressed chunk may inflate to per step, so a small
+# gzip body cannot expand into an unbounded buffer in one go.
+INFLATE_STEP = 1024 * 1024
+# Largest batch message body accepted after decompression.
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson")
+
+
+class LineTooLong(Exception):
+    pass
+
+
+def _inflate(state: dict, data: bytes):
+    while data:
+        out = state["inflate"].decompress(data, INFLATE_STEP)
+        if out:
+            yield out
+        if state["inflate"].eof:
+            # Concatenated gzip members, as written by clients that compress
+            # and flush per batch.
+            data = state["inflate"].unused_data
+            state["inflate"] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            data = state["inflate"].unconsumed_tail
+
+
+async def iter_ndjson(stream: AsyncIterator[bytes], gzipped: bool, max_line: int) -> AsyncIterator[bytes]:
+    """
+    Yield the non-empty lines of an NDJSON body as it arrives, inflating it
+    first when `gzipped`. Only the current partial line is kept in memory;
+    a line longer than `max_line` raises `LineTooLong`. Invalid gzip data
+    raises `zlib.error`.
+    """
+    state = {"inflate": zlib.decompressobj(16 + zlib.MAX_WBITS)}
+    pending = b""
+
+    async for chunk in stream:
+        pieces = _inflate(state, chunk) if gzipped else (chunk,)
+        for piece in pieces:
+            *lines, pending = (pending + piece).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+            if len(pending) > max_line:
+                raise LineTooLong()
+
+    if gzipped:
+        pending += state["inflate"].flush()
+    if pending.strip():
+        yield pending
+
+
+def _gunzip(body: bytes) -> bytes:
+    out = []
+    size = 0
+    for piece in _inflate({"inflate": zlib.decompressobj(16 + zlib.MAX_WBITS)}, body):
+        size += len(piece)
+        if size > MAX_MESSAGE_BYTES:
+            raise ValueError("Message inflates past MAX_MESSAGE_BYTES")
+        out.append(piece)
+    return b"".join(out)
+
+
+def unpack_message(body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> List[bytes]:
+    """
+    Record bodies carried by one AMQP message. Batching producers send NDJSON
+    (`content_type` application/x-ndjson), optionally gzip or zstd compressed
+    as flagged by `content_encoding`; any other message is a single record.
+    Undecodable bodies raise `ValueError` or `zlib.error`.
+    """
+    if content_encoding in ("gzip", "x-gzip"):
+        body = _gunzip(body)
+    elif content_encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd message but the zstandard package is not installed")
+        try:
+            body = zstandard.ZstdDecompressor().decompress(body, max_output_size=MAX_MESSAGE_BYTES)
+        except zstandard.ZstdError as exc:
+            raise ValueError(str(exc))
+    elif content_encoding not in (None, "", "identity"):
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+    if content_type not in NDJSON_TYPES:
+        return [body]
+    return [line for line in body.split(b"\n") if line.strip()]
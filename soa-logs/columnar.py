@@ -0,0 +1,421 @@
+import math
+import zipfile
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow output is optional; NumPy archives always work.
+    pa = None
+
+from retention import read_segment
+from rollups import normalize_path, status_class
+from storage import LogStore
+
+# Typed columns of a snapshot. `ts` is microseconds since the epoch, a
+# missing status code is 0, a missing latency is NaN and `sample_rate` is 1
+# unless the producer logged only a sample of these requests.
+STRING_COLUMNS = ("service", "level", "path", "method")
+COLUMNS = ("ts",) + STRING_COLUMNS + ("status_code", "latency_ms", "sample_rate")
+GROUP_KEYS = STRING_COLUMNS + ("status_class",)
+PERCENTILES = (0.50, 0.95, 0.99)
+DTYPES = {
+    "ts": np.int64,
+    **{name: np.int32 for name in STRING_COLUMNS},
+    "status_code": np.int32,
+    "latency_ms": np.float64,
+    "sample_rate": np.float64,
+}
+# The stored columns behind COLUMNS, in the same order; `path` is derived from `url`.
+SCAN_SQL = (
+    "ts, coalesce(service, ''), coalesce(level, ''), coalesce(url, ''), coalesce(method, ''), "
+    "coalesce(status_code, 0), latency_ms, coalesce(sample_rate, 1.0)"
+)
+
+
+class TooManyRows(Exception):
+    """The range holds more rows than the caller is willing to load."""
+
+
+def _scan_values(r) -> tuple:
+    """One stored row (SQLite row or archived dict) as a SCAN_SQL tuple."""
+    return (
+        r["ts"], r["service"] or "", r["level"] or "", r["url"] or "", r["method"] or "",
+        r["status_code"] or 0, r["latency_ms"], r["sample_rate"] or 1.0,
+    )
+
+
+class _Columns:
+    """
+    Typed columns filled a chunk of SCAN_SQL tuples at a time. The arrays are
+    allocated for `capacity` rows up front and only grow if more arrive.
+    Strings are dictionary-encoded per distinct value, not per row.
+    """
+
+    def __init__(self, capacity: int):
+        self.length = 0
+        self.capacity = capacity
+        self._arrays = {name: np.empty(capacity, dtype) for name, dtype in DTYPES.items()}
+        self._lookup: Dict[str, Dict[str, int]] = {name: {} for name in STRING_COLUMNS}
+        self._url_codes: Dict[str, int] = {}
+
+    def _grow(self, needed: int):
+        self.capacity = max(needed, self.capacity * 2)
+        for name, array in self._arrays.items():
+            grown = np.empty(self.capacity, array.dtype)
+            grown[: self.length] = array[: self.length]
+            self._arrays[name] = grown
+
+    def _encode(self, name: str, values: tuple) -> np.ndarray:
+        lookup = self._lookup[name]
+        if name == "path":
+            # Many urls normalize to one path, so urls get the code of their path.
+            codes = self._url_codes
+            for url in dict.fromkeys(values):
+                if url not in codes:
+                    codes[url] = lookup.setdefault(normalize_path(url), len(lookup))
+        else:
+            codes = lookup
+            for value in dict.fromkeys(values):
+                if value not in codes:
+                    codes[value] = len(codes)
+        return np.fromiter(map(codes.__getitem__, values), dtype=np.int32, count=len(values))
+
+    def append(self, rows: list):
+        if not rows:
+            return
+        end = self.length + len(rows)
+        if end > self.capacity:
+            self._grow(end)
+        for name, values in zip(COLUMNS, zip(*rows)):
+            if name in STRING_COLUMNS:
+                values = self._encode(name, values)
+            self._arrays[name][self.length:end] = np.asarray(values, dtype=DTYPES[name])
+        self.length = end
+
+    def frame(self) -> "Frame":
+        arrays = {name: array[: self.length] for name, array in self._arrays.items()}
+        return Frame(
+            arrays["ts"],
+            arrays["status_code"],
+            arrays["latency_ms"],
+            arrays["sample_rate"],
+            {name: arrays[name] for name in STRING_COLUMNS},
+            {name: list(self._lookup[name]) for name in STRING_COLUMNS},
+        )
+
+
+class Frame:
+    """
+    Rows as typed NumPy columns. String columns are dictionary-encoded:
+    `codes[name]` indexes into `categories[name]`, so filters and group-bys
+    compare small integers instead of strings.
+    """
+
+    def __init__(
+        self, ts, status_code, latency_ms, sample_rate, codes: Dict[str, np.ndarray], categories: Dict[str, list]
+    ):
+        self.ts = ts
+        self.status_code = status_code
+        self.latency_ms = latency_ms
+        self.sample_rate = sample_rate
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> "Frame":
+        """Build a frame from stored rows (SQLite rows or archived dicts)."""
+        values = [_scan_values(r) for r in rows]
+        columns = _Columns(len(values))
+        columns.append(values)
+        return columns.frame()
+
+    @classmethod
+    def concat(cls, frames: Sequence["Frame"]) -> "Frame":
+        frames = [frame for frame in frames if len(frame)] or list(frames[:1])
+        if len(frames) == 1:
+            return frames[0]
+        codes, categories = {}, {}
+        for name in STRING_COLUMNS:
+            merged: Dict[str, int] = {}
+            parts = []
+            for frame in frames:
+                # Re-map each frame's codes onto the merged dictionary.
+                remap = np.array(
+                    [merged.setdefault(value, len(merged)) for value in frame.categories[name]],
+                    dtype=np.int32,
+                )
+                parts.append(remap[frame.codes[name]])
+            codes[name] = np.concatenate(parts)
+            categories[name] = list(merged)
+        return cls(
+            np.concatenate([frame.ts for frame in frames]),
+            np.concatenate([frame.status_code for frame in frames]),
+            np.concatenate([frame.latency_ms for frame in frames]),
+            np.concatenate([frame.sample_rate for frame in frames]),
+            codes,
+            categories,
+        )
+
+    def strings(self, name: str) -> np.ndarray:
+        return np.array(self.categories[name], dtype=str)[self.codes[name]]
+
+    def mask_equal(self, name: str, value: str) -> np.ndarray:
+        try:
+            code = self.categories[name].index(value)
+        except ValueError:
+            return np.zeros(len(self), dtype=bool)
+        return self.codes[name] == code
+
+    def select(self, mask: np.ndarray) -> "Frame":
+        return Frame(
+            self.ts[mask],
+            self.status_code[mask],
+            self.latency_ms[mask],
+            self.sample_rate[mask],
+            {name: codes[mask] for name, codes in self.codes.items()},
+            self.categories,
+        )
+
+
+def load_frame(
+    store: LogStore, conn, start_ts: int, end_ts: int, max_rows: int, chunk_size: int = 50000
+) -> Frame:
+    """
+    The frame of a time range, read straight from SQL: the range is counted
+    first, so an oversized one fails before anything is loaded and the
+    arrays are allocated once, then filled `chunk_size` rows at a time with
+    `fetchmany`. Days moved to archive segments are read from the segments.
+    Raises TooManyRows past `max_rows` rows.
+    """
+    archives = {r["day"]: r for r in store.archives(conn, start_ts, end_ts)}
+    scans = []
+    total = 0
+    for day, table in store.partitions(conn, start_ts, end_ts):
+        where, params = "ts BETWEEN ? AND ?", [start_ts, end_ts]
+        if day in archives:
+            # Rows up to max_id are read from the segment below.
+            where += " AND id > ?"
+            params.append(archives[day]["max_id"])
+        total += conn.execute(f"SELECT count(*) FROM {table} WHERE {where}", params).fetchone()[0]
+        scans.append((table, where, params))
+    if total > max_rows:
+        raise TooManyRows(total)
+
+    columns = _Columns(total)
+    for table, where, params in scans:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT {SCAN_SQL} FROM {table} WHERE {where}", params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                columns.append(rows)
+                if columns.length > max_rows:
+                    raise TooManyRows(columns.length)
+        finally:
+            cursor.close()
+    for archive in archives.values():
+        segment = read_segment(archive["path"], start_ts, end_ts)
+        while True:
+            rows = [_scan_values(r) for r in islice(segment, chunk_size)]
+            if not rows:
+                break
+            columns.append(rows)
+            if columns.length > max_rows:
+                raise TooManyRows(columns.length)
+    return columns.frame()
+
+
+def _group_column(frame: Frame, key: str):
+    """Integer codes for one group-by key and the label of each code."""
+    if key == "status_class":
+        classes = frame.status_code // 100
+        return classes, lambda code: status_class(code * 100) if code else "unknown"
+    labels = frame.categories[key]
+    return frame.codes[key], lambda code: labels[code]
+
+
+def _percentiles(values: np.ndarray, weights: np.ndarray, groups: np.ndarray, n_groups: int, qs):
+    """Exact weighted per-group percentiles (nearest rank) from one sort."""
+    if not len(values):
+        return {q: np.full(n_groups, np.nan) for q in qs}
+    order = np.lexsort((values, groups))
+    ordered, cumulative = values[order], np.cumsum(weights[order])
+    rows = np.bincount(groups, minlength=n_groups)
+    totals = np.bincount(groups, weights=weights, minlength=n_groups)
+    first = np.cumsum(rows) - rows
+    before = np.concatenate(([0.0], cumulative))[first]
+    # Rounding in the running sum must not spill into a neighbouring group;
+    # empty groups are clamped anywhere valid and masked out below.
+    end = len(values) - 1
+    lo, hi = np.minimum(first, end), np.clip(first + rows - 1, 0, end)
+    result = {}
+    for q in qs:
+        index = np.clip(np.searchsorted(cumulative, before + q * totals), lo, hi)
+        result[q] = np.where(rows > 0, ordered[index], np.nan)
+    return result
+
+
+def _number(value) -> Optional[float]:
+    value = float(value)
+    return None if math.isnan(value) else round(value, 3)
+
+
+def _count(value: float):
+    return int(value) if float(value).is_integer() else round(float(value), 1)
+
+
+def aggregate(frame: Frame, by: Sequence[str], percentiles=PERCENTILES) -> List[dict]:
+    """
+    Request count, error rate and exact latency stats per combination of the
+    `by` keys, computed with NumPy over the whole frame at once. Sampled rows
+    are weighted by 1 / `sample_rate`.
+    """
+    if not len(frame):
+        return []
+    columns = [_group_column(frame, key) for key in by]
+    # Pack the per-key codes into one int64 so a single `unique` finds the groups.
+    packed = np.zeros(len(frame), dtype=np.int64)
+    for codes, _ in columns:
+        packed = packed * (int(codes.max()) + 1) + codes
+    _, first, group = np.unique(packed, return_index=True, return_inverse=True)
+    group = group.reshape(-1)
+    n_groups = len(first)
+
+    weight = 1 / frame.sample_rate
+    requests = np.bincount(group, weights=weight, minlength=n_groups)
+    errors = np.bincount(group, weights=weight * (frame.status_code >= 500), minlength=n_groups)
+    timed = ~np.isnan(frame.latency_ms)
+    latency, latency_group, latency_weight = frame.latency_ms[timed], group[timed], weight[timed]
+    latency_count = np.bincount(latency_group, weights=latency_weight, minlength=n_groups)
+    latency_sum = np.bincount(latency_group, weights=latency * latency_weight, minlength=n_groups)
+    latency_max = np.full(n_groups, np.nan)
+    np.fmax.at(latency_max, latency_group, latency)
+    quantiles = _percentiles(latency, latency_weight, latency_group, n_groups, percentiles)
+
+    results = []
+    for index, row in enumerate(first):
+        item = {key: label(int(codes[row])) for key, (codes, label) in zip(by, columns)}
+        count = float(latency_count[index])
+        item.update(
+            {
+                "requests": _count(requests[index]),
+                "error_rate": round(float(errors[index] / requests[index]), 4),
+                "latency_ms": {
+                    "count": _count(count),
+                    "avg": round(float(latency_sum[index]) / count, 3) if count else None,
+                    "max": _number(latency_max[index]),
+                    **{f"p{round(q * 100):g}": _number(quantiles[q][index]) for q in percentiles},
+                },
+            }
+        )
+        results.append(item)
+    results.sort(key=lambda item: tuple(str(item[key]) for key in by))
+    return results
+
+
+class _Sink:
+    """Write-only file object; `drain()` hands back what was written since the last call."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data, self._parts = b"".join(self._parts), []
+        return data
+
+
+class NpzWriter:
+    """
+    Streams a `.npz` archive holding one `.npy` member per column and chunk,
+    named `<column>-<chunk>` (e.g. `ts-00000`). Concatenating the members of
+    a column in name order gives the whole range.
+    """
+
+    media_type = "application/zip"
+    suffix = "npz"
+
+    def __init__(self):
+        self._sink = _Sink()
+        # An unseekable target makes zipfile write data descriptors, so each
+        # member can be sent as soon as it is complete.
+        self._zip = zipfile.ZipFile(self._sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+        self._chunk = 0
+
+    def write(self, frame: Frame) -> bytes:
+        arrays = {
+            "ts": frame.ts,
+            **{name: frame.strings(name) for name in STRING_COLUMNS},
+            "status_code": frame.status_code,
+            "latency_ms": frame.latency_ms,
+            "sample_rate": frame.sample_rate,
+        }
+        for name in COLUMNS:
+            with self._zip.open(f"{name}-{self._chunk:05d}.npy", "w", force_zip64=True) as fh:
+                np.lib.format.write_array(fh, arrays[name], allow_pickle=False)
+        self._chunk += 1
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.drain()
+
+
+class ArrowWriter:
+    """Streams an Arrow IPC stream with one record batch per chunk."""
+
+    media_type = "application/vnd.apache.arrow.stream"
+    suffix = "arrows"
+
+    def __init__(self):
+        self._schema = pa.schema(
+            [
+                ("ts", pa.timestamp("us", tz="UTC")),
+                *((name, pa.string()) for name in STRING_COLUMNS),
+                ("status_code", pa.int32()),
+                ("latency_ms", pa.float64()),
+                ("sample_rate", pa.float64()),
+            ]
+        )
+        self._sink = _Sink()
+        self._writer = pa.ipc.new_stream(self._sink, self._schema)
+
+    def write(self, frame: Frame) -> bytes:
+        batch = pa.record_batch(
+            [
+                pa.array(frame.ts, type=pa.timestamp("us", tz="UTC")),
+                *(
+                    pa.DictionaryArray.from_arrays(frame.codes[name], frame.categories[name]).cast(pa.string())
+                    for name in STRING_COLUMNS
+                ),
+                pa.array(frame.status_code, mask=frame.status_code == 0),
+                pa.array(frame.latency_ms, from_pandas=True),
+                pa.array(frame.sample_rate),
+            ],
+            schema=self._schema,
+        )
+        self._writer.write_batch(batch)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+EXPORT_FORMATS = {"npz": NpzWriter, "arrow": ArrowWriter}
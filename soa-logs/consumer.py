@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+import pika
+from pika.exceptions import AMQPError
+
+logger = logging.getLogger("soa-logs.consumer")
+
+
+class LogConsumer(threading.Thread):
+    """
+    Long-lived RabbitMQ consumer that hands messages to `handle_batch` in
+    batches. `handle_batch(messages, done)` gets `(properties, body)` pairs
+    and calls `done(ok)` once the batch is
+    durably stored (from any thread); the whole batch is then acked with one
+    `multiple=True` ack, or nacked for redelivery if storing failed.
+
+    A redelivered message is handed off in a batch of its own. If that fails
+    too, the message itself is the problem, so it goes to `quarantine`
+    (same signature) instead of being requeued again; only when that fails
+    as well is it nacked for another redelivery.
+    """
+
+    def __init__(
+        self,
+        connection_params: pika.ConnectionParameters,
+        exchange: str,
+        queue: str,
+        routing_key: str,
+        handle_batch: Callable[[List[tuple], Callable[[bool], None]], None],
+        quarantine: Optional[Callable[[List[tuple], Callable[[bool], None]], None]] = None,
+        prefetch: int = 500,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        lag_interval: float = 5.0,
+        drain_timeout: float = 5.0,
+    ):
+        super().__init__(name="log-consumer", daemon=True)
+        self.connection_params = connection_params
+        self.exchange = exchange
+        self.queue = queue
+        self.routing_key = routing_key
+        self.handle_batch = handle_batch
+        self.quarantine = quarantine
+        self.prefetch = prefetch
+        self.batch_size = max(1, min(batch_size, prefetch))
+        self.flush_interval = flush_interval
+        self.lag_interval = lag_interval
+        self.drain_timeout = drain_timeout
+
+        self.connection = None
+        self.channel = None
+        self._pending: List[bytes] = []
+        self._last_tag: Optional[int] = None
+        self._first_pending_at: Optional[float] = None
+        self._in_flight = 0
+        # [last_tag, size, ok, messages if redelivered] per handed-off batch,
+        # in delivery order.
+        self._unsettled: deque = deque()
+        self._generation = 0
+        self._consumer_tag: Optional[str] = None
+        self._stopping = threading.Event()
+        self._flush_requested = threading.Event()
+
+        self.connected = False
+        self.consumed = 0
+        self.batches = 0
+        self.quarantined = 0
+        self.queue_depth: Optional[int] = None
+        self.last_flush_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def _connect(self):
+        self.connection = pika.BlockingConnection(self.connection_params)
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=self.exchange, exchange_type="direct", durable=True
+        )
+        self.channel.queue_declare(queue=self.queue, durable=True)
+        self.channel.queue_bind(
+            queue=self.queue, exchange=self.exchange, routing_key=self.routing_key
+        )
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self._consumer_tag = self.channel.basic_consume(
+            queue=self.queue, on_message_callback=self._on_message
+        )
+        self.connected = True
+
+    def _on_message(self, channel, method, properties, body):
+        if method.redelivered:
+            # Possibly redelivered after a failed batch; alone in its batch,
+            # another failure can only be this message's.
+            self._flush()
+            self._pending.append((properties, body))
+            self._last_tag = method.delivery_tag
+            self._flush(redelivered=True)
+            return
+        if not self._pending:
+            self._first_pending_at = time.monotonic()
+        self._pending.append((properties, body))
+        self._last_tag = method.delivery_tag
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self, redelivered: bool = False):
+        if not self._pending:
+            return
+        batch, last_tag = self._pending, self._last_tag
+        self._pending = []
+        self._last_tag = None
+        self._first_pending_at = None
+        self._in_flight += len(batch)
+        state = [last_tag, len(batch), None, batch if redelivered else None]
+        self._unsettled.append(state)
+        self._hand_off(self.handle_batch, batch, state)
+
+    def _hand_off(self, handler, batch: List[tuple], state: list):
+        connection, channel, generation = self.connection, self.channel, self._generation
+
+        def _settle(ok: bool):
+            # Runs on the consumer thread; a stale generation means the broker
+            # already requeued these deliveries when the old connection dropped.
+            if generation != self._generation:
+                return
+            state[2] = ok
+            self._settle_finished(channel)
+
+        def _done(ok: bool):
+            try:
+                connection.add_callback_threadsafe(lambda: _settle(ok))
+            except Exception:
+                pass
+
+        handler(batch, _done)
+
+    def _settle_finished(self, channel):
+        # Batches can finish out of order (one writer per shard), and a
+        # multiple ack covers every earlier tag, so only the finished prefix
+        # is settled.
+        ack_tag = None
+        while self._unsettled and self._unsettled[0][2] is not None:
+            state = self._unsettled[0]
+            last_tag, size, ok, redelivered = state
+            if not ok and redelivered and self.quarantine and channel.is_open:
+                state[2] = state[3] = None
+                self.quarantined += size
+                self._hand_off(self.quarantine, redelivered, state)
+                break
+            self._unsettled.popleft()
+            self._in_flight -= size
+            if not channel.is_open:
+                continue
+            if ok:
+                ack_tag = last_tag
+                self.consumed += size
+                self.batches += 1
+                continue
+            if ack_tag is not None:
+                channel.basic_ack(delivery_tag=ack_tag, multiple=True)
+                ack_tag = None
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        if ack_tag is not None and channel.is_open:
+            channel.basic_ack(delivery_tag=ack_tag, multiple=True)
+            self.last_flush_at = time.time()
+
+    def _refresh_queue_depth(self):
+        frame = self.channel.queue_declare(queue=self.queue, durable=True, passive=True)
+        self.queue_depth = frame.method.message_count
+
+    def _drop_pending(self):
+        # Unacked deliveries are redelivered by the broker once the channel closes.
+        self._pending = []
+        self._last_tag = None
+        self._first_pending_at = None
+        self._in_flight = 0
+        self._unsettled.clear()
+        self._generation += 1
+
+    def _drain(self):
+        self.channel.basic_cancel(self._consumer_tag)
+        self._flush()
+        deadline = time.monotonic() + self.drain_timeout
+        while self._in_flight and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+
+    def _close(self):
+        self.connected = False
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def run(self):
+        backoff = 1.0
+        while not self._stopping.is_set():
+            try:
+                self._connect()
+                backoff = 1.0
+                self.last_error = None
+                next_lag_check = 0.0
+                while not self._stopping.is_set():
+                    self.connection.process_data_events(time_limit=self.flush_interval)
+                    now = time.monotonic()
+                    due = (
+                        self._first_pending_at is not None
+                        and now - self._first_pending_at >= self.flush_interval
+                    )
+                    if due or self._flush_requested.is_set():
+                        self._flush_requested.clear()
+                        self._flush()
+                    if now >= next_lag_check:
+                        self._refresh_queue_depth()
+                        next_lag_check = now + self.lag_interval
+                self._drain()
+            except Exception as exc:
+                self.last_error = str(exc)
+                logger.warning("Log consumer failed, reconnecting: %s", exc)
+            self._close()
+            self._drop_pending()
+            if self.last_error and not self._stopping.is_set():
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def request_flush(self):
+        self._flush_requested.set()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self.join(timeout)
+
+    def lag(self) -> dict:
+        pending_age = None
+        if self._first_pending_at is not None:
+            pending_age = round(time.monotonic() - self._first_pending_at, 3)
+        since_flush = None
+        if self.last_flush_at is not None:
+            since_flush = round(time.time() - self.last_flush_at, 3)
+        return {
+            "connected": self.connected,
+            "queue_depth": self.queue_depth,
+            "unacked": len(self._pending) + self._in_flight,
+            "in_flight": self._in_flight,
+            "oldest_unacked_age_seconds": pending_age,
+            "seconds_since_last_flush": since_flush,
+            "consumed": self.consumed,
+            "batches": self.batches,
+            "quarantined": self.quarantined,
+            "prefetch": self.prefetch,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,74 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Callable, List, Optional
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class ReadPool:
+    """
+    Fixed set of read-only SQLite connections served from a dedicated thread
+    pool, so queries never run on the event loop or on the threadpool that
+    other routes share. At most `size` queries run at once; callers wait up to
+    `acquire_timeout` seconds for a free connection and then get `PoolBusy`.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], size: int = 4, acquire_timeout: float = 5.0):
+        self._connect = connect
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._all: List[sqlite3.Connection] = []
+        self.waiting = 0
+
+    def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="log-read")
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = self._connect()
+            self._all.append(conn)
+            self._idle.put_nowait(conn)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        for conn in self._all:
+            conn.close()
+        self._all = []
+
+    @property
+    def in_use(self) -> int:
+        return self.size - self._idle.qsize() if self._idle else 0
+
+    @asynccontextmanager
+    async def connection(self):
+        self.waiting += 1
+        try:
+            conn = await asyncio.wait_for(self._idle.get(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolBusy()
+        finally:
+            self.waiting -= 1
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def call(self, fn, *args, **kwargs):
+        """Run `fn` on a read thread; the caller must hold the connection it uses."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(conn, *args, **kwargs)` with a pooled connection."""
+        async with self.connection() as conn:
+            return await self.call(fn, conn, *args, **kwargs)
+
+    def stats(self) -> dict:
+        return {"size": self.size, "in_use": self.in_use, "waiting": self.waiting}
@@ -0,0 +1,237 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Tuple
+
+from rollups import prune_rollups
+from storage import DAY_US, LOG_COLUMNS, LogStore, decode_extra, parse_duration_ms, stored_sample_rate, to_epoch_us
+
+logger = logging.getLogger("soa-logs.retention")
+
+
+def _row_key(row) -> Tuple[int, int]:
+    return row["ts"], row["id"]
+
+
+def _day_start(day: str) -> int:
+    return to_epoch_us(datetime.strptime(day, "%Y%m%d"))
+
+
+def read_segment(
+    path: str, start_ts: int, end_ts: int, after: Optional[Tuple[int, int]] = None
+) -> Iterator[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        for line in fh:
+            row = json.loads(line)
+            row.setdefault("detail", None)
+            row.setdefault("extra", None)
+            if "latency_ms" not in row:
+                # Written before these had their own columns.
+                row["latency_ms"] = parse_duration_ms(row["detail"])
+                row["sample_rate"] = stored_sample_rate(row["extra"], row.get("raw"))
+            if row["ts"] < start_ts:
+                continue
+            if row["ts"] > end_ts:
+                break
+            if after is not None and _row_key(row) <= after:
+                continue
+            yield row
+
+
+def iter_range(
+    store: LogStore,
+    conn: sqlite3.Connection,
+    start_ts: int,
+    end_ts: int,
+    after: Optional[Tuple[int, int]] = None,
+) -> Iterator:
+    """
+    Like `store.query_range`, but days that retention moved to archive
+    segments are read back from those segments, so a range reaching past the
+    hot window still comes back complete and ordered by (ts, id).
+    """
+    archives = {r["day"]: r for r in store.archives(conn, start_ts, end_ts)}
+    if not archives:
+        yield from store.query_range(conn, start_ts, end_ts, after=after)
+        return
+
+    hot = dict(store.partitions(conn, start_ts, end_ts))
+    for day in sorted(set(archives) | set(hot)):
+        lo = max(start_ts, _day_start(day))
+        hi = min(end_ts, _day_start(day) + DAY_US - 1)
+        archive = archives.get(day)
+        if archive is None:
+            yield from store.query_range(conn, lo, hi, after=after)
+            continue
+        segment = read_segment(archive["path"], lo, hi, after)
+        if day not in hot:
+            yield from segment
+            continue
+        # Rows up to max_id are in the segment (and may still be mid-deletion
+        # from the partition); anything newer arrived late and is still hot.
+        late = store.query_range(conn, lo, hi, after=after, min_id=archive["max_id"])
+        yield from heapq.merge(segment, late, key=_row_key)
+
+
+def remove_segments(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class RetentionWorker(threading.Thread):
+    """
+    Moves days older than `hot_days` out of SQLite: each day is written to a
+    gzip JSONL segment, then deleted from its partition in small transactions
+    so the log writer never waits long for the lock, and freed pages are
+    returned with incremental vacuum.
+    """
+
+    def __init__(
+        self,
+        store: LogStore,
+        archive_dir: str,
+        hot_days: int,
+        rollup_days: int = 90,
+        chunk_size: int = 5000,
+        interval: float = 3600.0,
+        pause: float = 0.05,
+        vacuum_pages: int = 500,
+    ):
+        super().__init__(name="log-retention", daemon=True)
+        self.store = store
+        self.archive_dir = archive_dir
+        self.hot_days = hot_days
+        self.rollup_days = rollup_days
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self._stopping = threading.Event()
+
+        self.archived_days = 0
+        self.deleted_rows = 0
+        self.last_run_at: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = self.store.connect()
+        conn.execute("PRAGMA busy_timeout = 5000")
+        return conn
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = str(exc)
+                logger.error("Retention pass failed: %s", exc)
+            self.last_run_at = datetime.now(timezone.utc).isoformat()
+            self._stopping.wait(self.interval)
+
+    def run_once(self):
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff = (today - timedelta(days=self.hot_days)).strftime("%Y%m%d")
+        conn = self._connect()
+        try:
+            for day, _ in self.store.partitions(conn):
+                if day >= cutoff or self._stopping.is_set():
+                    break
+                self.expire_day(conn, day)
+            rollup_cutoff = to_epoch_us(today - timedelta(days=self.rollup_days))
+            while not self._stopping.is_set() and prune_rollups(conn, rollup_cutoff):
+                conn.commit()
+                self._stopping.wait(self.pause)
+            conn.commit()
+            self.vacuum(conn)
+        finally:
+            conn.close()
+
+    def expire_day(self, conn: sqlite3.Connection, day: str):
+        max_id = self.archive_day(conn, day)
+        while not self._stopping.is_set():
+            deleted = self.store.delete_chunk(conn, day, max_id, self.chunk_size)
+            conn.commit()
+            self.deleted_rows += deleted
+            if deleted < self.chunk_size:
+                break
+            self._stopping.wait(self.pause)
+        conn.execute("BEGIN IMMEDIATE")
+        if self.store.is_empty(conn, day):
+            self.store.drop_partition(conn, day)
+        conn.commit()
+
+    def archive_day(self, conn: sqlite3.Connection, day: str) -> int:
+        """Write (or extend) the day's segment and return the highest archived id."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"logs-{day}.jsonl.gz")
+        existing = conn.execute(
+            "SELECT path, max_id FROM log_archives WHERE day = ?", (day,)
+        ).fetchone()
+        floor = existing["max_id"] if existing else 0
+        fresh = (
+            {**dict(r), "extra": decode_extra(r["extra"]) or None}
+            for r in conn.execute(
+                f"SELECT {LOG_COLUMNS} FROM logs_{day} WHERE id > ? ORDER BY ts ASC, id ASC",
+                (floor,),
+            )
+        )
+        rows = fresh
+        if existing:
+            rows = heapq.merge(read_segment(existing["path"], 0, 2**62), fresh, key=_row_key)
+
+        tmp_path = path + ".tmp"
+        count = 0
+        max_id = floor
+        with open(tmp_path, "wb") as out:
+            with gzip.GzipFile(fileobj=out, mode="wb") as fh:
+                for row in rows:
+                    line = json.dumps(row, default=str, separators=(",", ":")) + "\n"
+                    fh.write(line.encode("utf-8"))
+                    count += 1
+                    max_id = max(max_id, row["id"])
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+
+        start = _day_start(day)
+        conn.execute(
+            """
+            INSERT INTO log_archives (day, path, rows, max_id, start_ts, end_ts)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                path = excluded.path, rows = excluded.rows, max_id = excluded.max_id
+            """,
+            (day, path, count, max_id, start, start + DAY_US - 1),
+        )
+        conn.commit()
+        self.archived_days += 1
+        return max_id
+
+    def vacuum(self, conn: sqlite3.Connection):
+        while not self._stopping.is_set():
+            if not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+            self._stopping.wait(self.pause)
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "hot_days": self.hot_days,
+            "archived_days": self.archived_days,
+            "deleted_rows": self.deleted_rows,
+            "last_run_at": self.last_run_at,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,280 @@
+import math
+import re
+import sqlite3
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from storage import from_epoch_us, parse_duration_ms, sampled_rate
+
+MINUTE_US = 60_000_000
+# Log-spaced latency buckets, 8 per power of two (~9% wide), so histograms
+# from any set of minutes can be merged by adding counts per bucket.
+BUCKETS_PER_OCTAVE = 8
+MIN_LATENCY_MS = 0.01
+
+ID_SEGMENT_RE = re.compile(
+    r"^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{24,})$"
+)
+
+
+def normalize_path(url: Optional[str]) -> str:
+    if not url:
+        return ""
+    path = urlsplit(url).path or "/"
+    segments = ["{id}" if ID_SEGMENT_RE.match(seg) else seg for seg in path.split("/")]
+    return "/".join(segments)
+
+
+def status_class(status_code) -> str:
+    try:
+        return f"{int(status_code) // 100}xx"
+    except (TypeError, ValueError):
+        return "unknown"
+
+
+def latency_bucket(ms: float) -> int:
+    return math.floor(math.log2(max(ms, MIN_LATENCY_MS)) * BUCKETS_PER_OCTAVE)
+
+
+def bucket_value(bucket: int) -> float:
+    return 2 ** ((bucket + 0.5) / BUCKETS_PER_OCTAVE)
+
+
+def sample_weight(sample_rate) -> float:
+    """How many requests one record stands for when producers log a sample."""
+    rate = sampled_rate(sample_rate)
+    return 1.0 / rate if rate else 1.0
+
+
+def _count(value: float):
+    # Weighted counts are fractional; keep whole numbers as ints in responses.
+    return int(value) if float(value).is_integer() else round(value, 1)
+
+
+def init_rollups(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_rollups (
+            minute INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status_class TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            latency_count INTEGER NOT NULL,
+            latency_sum REAL NOT NULL,
+            latency_max REAL,
+            PRIMARY KEY (minute, service, path, status_class)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_rollup_latency (
+            minute INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status_class TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (minute, service, path, status_class, bucket)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.commit()
+
+
+def update_rollups(conn: sqlite3.Connection, entries: List[dict]):
+    """
+    Fold "Request handled" entries into the per-minute rollups. Runs inside the
+    writer's transaction, so rollups commit atomically with the rows they count.
+    A sampled entry counts as 1 / `sample_rate` requests.
+    """
+    counts = {}
+    buckets = {}
+    for entry in entries:
+        if entry.get("message") != "Request handled" or entry.get("status_code") is None:
+            continue
+        key = (
+            entry["ts"] // MINUTE_US * MINUTE_US,
+            entry.get("service") or "",
+            normalize_path(entry.get("url") or entry.get("path")),
+            status_class(entry.get("status_code")),
+        )
+        weight = sample_weight(entry.get("sample_rate"))
+        stats = counts.setdefault(key, [0, 0, 0.0, None])
+        stats[0] += weight
+        latency = parse_duration_ms(entry.get("detail"))
+        if latency is None:
+            continue
+        stats[1] += weight
+        stats[2] += latency * weight
+        stats[3] = latency if stats[3] is None else max(stats[3], latency)
+        bucket_key = key + (latency_bucket(latency),)
+        buckets[bucket_key] = buckets.get(bucket_key, 0) + weight
+
+    if not counts:
+        return
+    conn.executemany(
+        """
+        INSERT INTO log_rollups
+            (minute, service, path, status_class, count, latency_count, latency_sum, latency_max)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (minute, service, path, status_class) DO UPDATE SET
+            count = count + excluded.count,
+            latency_count = latency_count + excluded.latency_count,
+            latency_sum = latency_sum + excluded.latency_sum,
+            latency_max = max(coalesce(latency_max, excluded.latency_max),
+                              coalesce(excluded.latency_max, latency_max))
+        """,
+        [key + tuple(stats) for key, stats in counts.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO log_rollup_latency (minute, service, path, status_class, bucket, count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (minute, service, path, status_class, bucket) DO UPDATE SET
+            count = count + excluded.count
+        """,
+        [key + (count,) for key, count in buckets.items()],
+    )
+
+
+def prune_rollups(conn: sqlite3.Connection, before_ts: int, chunk_minutes: int = 60) -> bool:
+    """Delete up to `chunk_minutes` of rollups older than `before_ts`; False when none remain."""
+    oldest = conn.execute("SELECT min(minute) FROM log_rollups").fetchone()[0]
+    if oldest is None or oldest >= before_ts:
+        return False
+    upto = min(oldest + chunk_minutes * MINUTE_US, before_ts)
+    conn.execute("DELETE FROM log_rollups WHERE minute < ?", (upto,))
+    conn.execute("DELETE FROM log_rollup_latency WHERE minute < ?", (upto,))
+    return True
+
+
+def _percentile(histogram: dict, total: int, q: float, ceiling: Optional[float] = None) -> Optional[float]:
+    """Nearest-rank percentile as its bucket's midpoint, capped at `ceiling` (the observed max)."""
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    value = bucket_value(max(histogram))
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            value = bucket_value(bucket)
+            break
+    if ceiling is not None:
+        value = min(value, ceiling)
+    return round(value, 3)
+
+
+def collect_rollups(
+    conn: sqlite3.Connection,
+    start_ts: int,
+    end_ts: int,
+    service: Optional[str] = None,
+    path: Optional[str] = None,
+    interval_minutes: Optional[int] = None,
+) -> dict:
+    """Raw counts and histograms per (slot, service, path); see `summarize_rollups`."""
+    start_minute = start_ts // MINUTE_US * MINUTE_US
+    clauses = ["minute BETWEEN ? AND ?"]
+    params: list = [start_minute, end_ts]
+    if service:
+        clauses.append("service = ?")
+        params.append(service)
+    if path:
+        clauses.append("path = ?")
+        params.append(path)
+    where = " AND ".join(clauses)
+    step = interval_minutes * MINUTE_US if interval_minutes else None
+
+    def slot(minute: int) -> int:
+        if step is None:
+            return start_minute
+        return start_minute + (minute - start_minute) // step * step
+
+    groups = {}
+    for r in conn.execute(
+        f"""
+        SELECT minute, service, path, status_class, count, latency_count, latency_sum, latency_max
+        FROM log_rollups WHERE {where}
+        """,
+        params,
+    ):
+        key = (slot(r[0]), r[1], r[2])
+        group = groups.setdefault(
+            key,
+            {"count": 0, "by_status": {}, "latency_count": 0, "latency_sum": 0.0,
+             "latency_max": None, "histogram": {}},
+        )
+        group["count"] += r[4]
+        group["by_status"][r[3]] = group["by_status"].get(r[3], 0) + r[4]
+        group["latency_count"] += r[5]
+        group["latency_sum"] += r[6]
+        if r[7] is not None:
+            group["latency_max"] = max(group["latency_max"] or 0.0, r[7])
+
+    for r in conn.execute(
+        f"""
+        SELECT minute, service, path, bucket, SUM(count)
+        FROM log_rollup_latency WHERE {where}
+        GROUP BY minute, service, path, bucket
+        """,
+        params,
+    ):
+        group = groups.get((slot(r[0]), r[1], r[2]))
+        if group is not None:
+            group["histogram"][r[3]] = group["histogram"].get(r[3], 0) + r[4]
+    return groups
+
+
+def merge_rollups(parts: List[dict]) -> dict:
+    """Add up `collect_rollups` results from several databases."""
+    merged = {}
+    for groups in parts:
+        for key, group in groups.items():
+            target = merged.get(key)
+            if target is None:
+                merged[key] = group
+                continue
+            target["count"] += group["count"]
+            for status, count in group["by_status"].items():
+                target["by_status"][status] = target["by_status"].get(status, 0) + count
+            target["latency_count"] += group["latency_count"]
+            target["latency_sum"] += group["latency_sum"]
+            if group["latency_max"] is not None:
+                target["latency_max"] = max(target["latency_max"] or 0.0, group["latency_max"])
+            for bucket, count in group["histogram"].items():
+                target["histogram"][bucket] = target["histogram"].get(bucket, 0) + count
+    return merged
+
+
+def summarize_rollups(
+    groups: dict, start_ts: int, end_ts: int, interval_minutes: Optional[int] = None
+) -> List[dict]:
+    start_minute = start_ts // MINUTE_US * MINUTE_US
+    window_minutes = interval_minutes or max((end_ts - start_minute) / MINUTE_US, 1)
+    results = []
+    for (slot_start, svc, route), group in sorted(groups.items()):
+        latency_count = group["latency_count"]
+        latency_max = group["latency_max"]
+        histogram = group["histogram"]
+        results.append(
+            {
+                "start": from_epoch_us(slot_start).isoformat(),
+                "service": svc,
+                "path": route,
+                "requests": _count(group["count"]),
+                "requests_per_min": round(group["count"] / window_minutes, 3),
+                "by_status": {status: _count(count) for status, count in group["by_status"].items()},
+                "error_rate": round(group["by_status"].get("5xx", 0) / group["count"], 4),
+                "latency_ms": {
+                    "avg": round(group["latency_sum"] / latency_count, 3) if latency_count else None,
+                    "max": latency_max,
+                    "p50": _percentile(histogram, latency_count, 0.50, latency_max),
+                    "p95": _percentile(histogram, latency_count, 0.95, latency_max),
+                    "p99": _percentile(histogram, latency_count, 0.99, latency_max),
+                },
+            }
+        )
+    return results
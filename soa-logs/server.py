@@ -1,11 +1,31 @@
+import asyncio
 import json
 import os
 import sqlite3
-from datetime import datetime, timedelta
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Optional
 
 import pika
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from bulk import LineTooLong, iter_ndjson, unpack_message
+from columnar import EXPORT_FORMATS, GROUP_KEYS, Frame, TooManyRows, aggregate, load_frame, pa
+from consumer import LogConsumer
+from metrics import Counter, Gauge, Histogram, render
+from readpool import PoolBusy, ReadPool
+from retention import RetentionWorker, iter_range, remove_segments
+from rollups import collect_rollups, init_rollups, merge_rollups, summarize_rollups, update_rollups
+from shards import Shard, ShardSet, shard_archive_dir, shard_paths
+from storage import LogStore, normalize_entry, row_payload, to_epoch_us
+from tail import TailBuffer, tail_item
+from tracing import build_waterfall
+from writer import APPLY_SECONDS, COMMIT_SECONDS, LogWriter
 
 APP_PORT = int(os.getenv("APP_PORT", "8010"))
 DB_PATH = os.getenv("LOG_DB_PATH", "/app/logs.db")
@@ -18,6 +38,39 @@ RABBITMQ_EXCHANGE = os.getenv("RABBITMQ_EXCHANGE", "logs-exchange")
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "logs-queue")
 RABBITMQ_ROUTING_KEY = os.getenv("RABBITMQ_ROUTING_KEY", "logs.route")
 
+CONSUMER_ENABLED = os.getenv("LOG_CONSUMER_ENABLED", "true").lower() == "true"
+CONSUMER_PREFETCH = int(os.getenv("LOG_CONSUMER_PREFETCH", "2000"))
+CONSUMER_BATCH_SIZE = int(os.getenv("LOG_CONSUMER_BATCH_SIZE", "250"))
+CONSUMER_FLUSH_INTERVAL = float(os.getenv("LOG_CONSUMER_FLUSH_INTERVAL", "0.2"))
+
+WRITER_BATCH_SIZE = int(os.getenv("LOG_WRITER_BATCH_SIZE", "1000"))
+WRITER_FLUSH_INTERVAL = float(os.getenv("LOG_WRITER_FLUSH_INTERVAL", "0.25"))
+WRITER_MAX_BUFFER = int(os.getenv("LOG_WRITER_MAX_BUFFER", "50000"))
+DB_SYNCHRONOUS = os.getenv("LOG_DB_SYNCHRONOUS", "FULL")
+
+BULK_BATCH_SIZE = int(os.getenv("LOG_BULK_BATCH_SIZE", "500"))
+BULK_MAX_LINE_BYTES = int(os.getenv("LOG_BULK_MAX_LINE_BYTES", str(1024 * 1024)))
+BULK_RETRY_AFTER = int(os.getenv("LOG_BULK_RETRY_AFTER", "1"))
+
+MAX_PAGE_SIZE = int(os.getenv("LOG_MAX_PAGE_SIZE", "5000"))
+STREAM_CHUNK_SIZE = int(os.getenv("LOG_STREAM_CHUNK_SIZE", "500"))
+READ_POOL_SIZE = int(os.getenv("LOG_READ_POOL_SIZE", "4"))
+READ_ACQUIRE_TIMEOUT = float(os.getenv("LOG_READ_ACQUIRE_TIMEOUT", "5"))
+EXPORT_CHUNK_SIZE = int(os.getenv("LOG_EXPORT_CHUNK_SIZE", "50000"))
+AGGREGATE_MAX_ROWS = int(os.getenv("LOG_AGGREGATE_MAX_ROWS", "1000000"))
+
+SHARD_COUNT = int(os.getenv("LOG_SHARDS", "1"))
+SHARD_KEY = os.getenv("LOG_SHARD_KEY", "service")
+
+TAIL_BUFFER_SIZE = int(os.getenv("LOG_TAIL_BUFFER_SIZE", "10000"))
+TAIL_KEEPALIVE = float(os.getenv("LOG_TAIL_KEEPALIVE", "15"))
+
+RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "7"))
+ROLLUP_RETENTION_DAYS = int(os.getenv("LOG_ROLLUP_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.getenv("LOG_RETENTION_INTERVAL", "3600"))
+RETENTION_CHUNK_SIZE = int(os.getenv("LOG_RETENTION_CHUNK_SIZE", "5000"))
+ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "/app/archive")
+
 app = FastAPI(title="Logging Service")
 
 app.add_middleware(
@@ -29,49 +82,31 @@ app.add_middleware(
 )
 
 
-def get_db_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-
-def init_db():
-    with get_db_conn() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT NOT NULL,
-                level TEXT,
-                url TEXT,
-                correlation_id TEXT,
-                service TEXT,
-                message TEXT,
-                raw TEXT
-            )
-            """
-        )
-        conn.commit()
-
+INGESTED = Counter("soa_logs_ingested_total", "Log messages received, by source.", ("source",))
+MALFORMED = Counter(
+    "soa_logs_malformed_total",
+    "Messages stored as plain text: not a JSON object, or failed to store even on their own.",
+)
+HTTP_SECONDS = Histogram(
+    "soa_logs_http_request_seconds", "Time until the response starts, by route.", ("method", "route")
+)
 
-def parse_timestamp(raw):
-    if not raw:
-        return datetime.utcnow()
-    try:
-        return datetime.fromisoformat(str(raw).replace("Z", "+00:00"))
-    except Exception:
-        return datetime.utcnow()
+tail = TailBuffer(TAIL_BUFFER_SIZE)
+shards: ShardSet = None
 
 
-def get_rabbit_channel():
+def get_rabbit_params(heartbeat: int = 0):
     credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-    params = pika.ConnectionParameters(
+    return pika.ConnectionParameters(
         host=RABBITMQ_HOST,
         port=RABBITMQ_PORT,
         credentials=credentials,
-        heartbeat=0,
+        heartbeat=heartbeat,
     )
-    connection = pika.BlockingConnection(params)
+
+
+def get_rabbit_channel():
+    connection = pika.BlockingConnection(get_rabbit_params())
     channel = connection.channel()
     channel.exchange_declare(
         exchange=RABBITMQ_EXCHANGE, exchange_type="direct", durable=True
@@ -83,115 +118,733 @@ def get_rabbit_channel():
     return connection, channel
 
 
-def save_log(entry: dict):
-    with get_db_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO logs (timestamp, level, url, correlation_id, service, message, raw)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                entry.get("timestamp", datetime.utcnow().isoformat()),
-                entry.get("level"),
-                entry.get("url") or entry.get("path"),
-                entry.get("correlation_id"),
-                entry.get("service"),
-                entry.get("message"),
-                json.dumps(entry, default=str),
-            ),
+def apply_batch(store: LogStore, conn: sqlite3.Connection, entries: list):
+    store.insert(conn, entries)
+    update_rollups(conn, entries)
+
+
+def save_logs(entries: list) -> bool:
+    return shards.write(entries)
+
+
+def malformed_entry(body: bytes) -> dict:
+    MALFORMED.inc()
+    text = body.decode("utf-8", errors="replace")
+    return normalize_entry({"timestamp": None, "level": "INFO", "message": text, "raw": text})
+
+
+def decode_log(body: bytes) -> dict:
+    try:
+        payload = json.loads(body.decode("utf-8"))
+        if not isinstance(payload, dict):
+            raise ValueError("Log payload must be an object")
+    except Exception:
+        return malformed_entry(body)
+    return normalize_entry(payload)
+
+
+def message_bodies(messages: list) -> list:
+    """Record bodies of `(properties, body)` messages, unpacking batched ones."""
+    bodies = []
+    for properties, body in messages:
+        try:
+            bodies += unpack_message(
+                body,
+                getattr(properties, "content_type", None),
+                getattr(properties, "content_encoding", None),
+            )
+        except (ValueError, zlib.error):
+            # Kept as a plain-text entry, like other undecodable bodies,
+            # rather than nacked and redelivered forever.
+            bodies.append(body)
+    return bodies
+
+
+def ingest_batch(messages: list, done):
+    bodies = message_bodies(messages)
+    INGESTED.inc(len(bodies), source="amqp")
+    shards.submit([decode_log(body) for body in bodies], done)
+
+
+def quarantine_batch(messages: list, done):
+    # A delivery that failed again in a batch of its own has its records kept
+    # as plain text, so it is neither requeued forever nor lost.
+    shards.submit([malformed_entry(body) for body in message_bodies(messages)], done)
+
+
+consumer: LogConsumer = None
+
+
+def open_shard(index: int, db_path: str) -> Shard:
+    store = LogStore(db_path)
+    store.init()
+    with store.connect() as conn:
+        init_rollups(conn)
+    shard = Shard(
+        index,
+        store,
+        ReadPool(store.connect_readonly, size=READ_POOL_SIZE, acquire_timeout=READ_ACQUIRE_TIMEOUT),
+        shard_archive_dir(ARCHIVE_DIR, index),
+    )
+    shard.writer = LogWriter(
+        db_path,
+        partial(apply_batch, store),
+        max_batch=WRITER_BATCH_SIZE,
+        max_delay=WRITER_FLUSH_INTERVAL,
+        max_buffer=WRITER_MAX_BUFFER,
+        synchronous=DB_SYNCHRONOUS,
+        on_commit=tail.publish,
+        on_rollback=store.reset_cache,
+        name=f"log-writer-{index}",
+    )
+    shard.writer.start()
+    shard.read_pool.open()
+    if RETENTION_DAYS > 0:
+        shard.retention = RetentionWorker(
+            store,
+            shard.archive_dir,
+            hot_days=RETENTION_DAYS,
+            rollup_days=ROLLUP_RETENTION_DAYS,
+            chunk_size=RETENTION_CHUNK_SIZE,
+            interval=RETENTION_INTERVAL,
         )
-        conn.commit()
+        shard.retention.start()
+    return shard
 
 
 @app.on_event("startup")
 def on_startup():
-    init_db()
+    global shards, consumer
+    shards = ShardSet(
+        [open_shard(index, path) for index, path in enumerate(shard_paths(DB_PATH, SHARD_COUNT))],
+        key=SHARD_KEY,
+    )
+    tail.attach(asyncio.get_running_loop())
+    if CONSUMER_ENABLED:
+        consumer = LogConsumer(
+            get_rabbit_params(heartbeat=30),
+            exchange=RABBITMQ_EXCHANGE,
+            queue=RABBITMQ_QUEUE,
+            routing_key=RABBITMQ_ROUTING_KEY,
+            handle_batch=ingest_batch,
+            quarantine=quarantine_batch,
+            prefetch=CONSUMER_PREFETCH,
+            batch_size=CONSUMER_BATCH_SIZE,
+            flush_interval=CONSUMER_FLUSH_INTERVAL,
+        )
+        consumer.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    for shard in shards or ():
+        if shard.retention:
+            shard.retention.stop()
+    if consumer:
+        consumer.stop()
+    for shard in shards or ():
+        shard.writer.stop()
+        shard.read_pool.close()
+        shard.close()
+
+
+@app.exception_handler(PoolBusy)
+def pool_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many concurrent log queries"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.middleware("http")
+async def observe_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=route.path if route else "unmatched",
+    )
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus text exposition of the ingest pipeline, storage and query latency.
+    """
+    committed = Counter("soa_logs_committed_rows_total", "Rows committed by the log writer.", ("shard",))
+    buffered = Gauge("soa_logs_writer_buffered", "Entries waiting for the next commit.", ("shard",))
+    pool_in_use = Gauge("soa_logs_read_pool_in_use", "Read connections currently running a query.", ("shard",))
+    pool_waiting = Gauge("soa_logs_read_pool_waiting", "Queries waiting for a read connection.", ("shard",))
+    db_bytes = Gauge("soa_logs_db_bytes", "Size of the SQLite files on disk.", ("shard", "file"))
+    day_rows = Gauge("soa_logs_partition_rows", "Rows per day partition still in SQLite.", ("shard", "day"))
+    partition_rows = [await run_in_threadpool(shard.partition_rows) for shard in shards]
+    for shard, days in zip(shards, partition_rows):
+        committed.set_total(shard.writer.committed_rows, shard=shard.index)
+        buffered.set(shard.writer.buffered, shard=shard.index)
+        pool_in_use.set(shard.read_pool.in_use, shard=shard.index)
+        pool_waiting.set(shard.read_pool.waiting, shard=shard.index)
+        for name, suffix in (("db", ""), ("wal", "-wal")):
+            try:
+                db_bytes.set(os.path.getsize(shard.store.db_path + suffix), shard=shard.index, file=name)
+            except OSError:
+                pass
+        for day, rows in days:
+            day_rows.set(rows, shard=shard.index, day=day)
+
+    lag = consumer.lag() if consumer else {}
+    gauges = [
+        ("soa_logs_queue_depth", "Messages waiting in the RabbitMQ queue.", lag.get("queue_depth")),
+        ("soa_logs_consumer_connected", "1 while the consumer holds a broker connection.",
+         int(lag["connected"]) if lag else None),
+        ("soa_logs_consumer_unacked", "Messages delivered but not yet acknowledged.", lag.get("unacked")),
+        ("soa_logs_consumer_oldest_unacked_seconds", "Age of the oldest unacknowledged message.",
+         lag.get("oldest_unacked_age_seconds")),
+        ("soa_logs_tail_viewers", "Open live tail streams.", tail.viewers),
+    ]
+    state = []
+    for name, help, value in gauges:
+        if value is not None:
+            gauge = Gauge(name, help)
+            gauge.set(value)
+            state.append(gauge)
+
+    body = render(
+        [INGESTED, MALFORMED, committed, buffered, *state, APPLY_SECONDS, COMMIT_SECONDS,
+         pool_in_use, pool_waiting, db_bytes, day_rows, HTTP_SECONDS]
+    )
+    return Response(body, media_type="text/plain; version=0.0.4")
+
+
+def _per_shard(values: list):
+    return values[0] if len(values) == 1 else values
+
+
+@app.get("/logs/consumer")
+async def consumer_status():
+    extra = {
+        "shards": len(shards),
+        "writer": _per_shard([shard.writer.stats() for shard in shards]),
+        "retention": _per_shard([shard.retention.stats() if shard.retention else None for shard in shards]),
+        "read_pool": _per_shard([shard.read_pool.stats() for shard in shards]),
+        "tail": {"epoch": tail.epoch, "seq": tail.seq, "viewers": tail.viewers},
+    }
+    if not consumer:
+        return {"enabled": False, **extra}
+    return {"enabled": True, **consumer.lag(), **extra}
 
 
 @app.post("/logs")
 def pull_logs():
     """
-    Connect to RabbitMQ and persist all pending logs into the service database.
+    Flush the background consumer, or drain RabbitMQ on demand when it is disabled.
     """
+    if consumer:
+        consumer.request_flush()
+        shards.flush()
+        return {"message": "Consumer running", "count": consumer.consumed, **consumer.lag()}
+
     connection, channel = get_rabbit_channel()
     saved = 0
     try:
         while True:
-            method_frame, header_frame, body = channel.basic_get(
-                queue=RABBITMQ_QUEUE, auto_ack=False
-            )
-            if method_frame is None:
+            messages = []
+            last_tag = None
+            while len(messages) < CONSUMER_BATCH_SIZE:
+                method_frame, header_frame, body = channel.basic_get(
+                    queue=RABBITMQ_QUEUE, auto_ack=False
+                )
+                if method_frame is None:
+                    break
+                messages.append((header_frame, body))
+                last_tag = method_frame.delivery_tag
+            if not messages:
                 break
-            try:
-                payload = json.loads(body.decode("utf-8"))
-                payload["timestamp"] = parse_timestamp(payload.get("timestamp")).isoformat()
-            except Exception:
-                payload = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "level": "INFO",
-                    "message": body.decode("utf-8"),
-                    "raw": body.decode("utf-8"),
-                }
-            save_log(payload)
-            channel.basic_ack(method_frame.delivery_tag)
-            saved += 1
+            bodies = message_bodies(messages)
+            INGESTED.inc(len(bodies), source="pull")
+            if not save_logs([decode_log(body) for body in bodies]):
+                channel.basic_nack(last_tag, multiple=True, requeue=True)
+                raise HTTPException(status_code=500, detail="Failed to store logs")
+            channel.basic_ack(last_tag, multiple=True)
+            saved += len(bodies)
     finally:
         connection.close()
 
     return {"message": "Logs pulled", "count": saved}
 
 
+def _submit_bulk(bodies: list, loop: asyncio.AbstractEventLoop):
+    """Queue one bulk batch without blocking; returns a future for its commit, or None if full."""
+    future = loop.create_future()
+
+    def _settle(ok: bool):
+        if not future.done():
+            future.set_result(ok)
+
+    entries = [decode_log(body) for body in bodies]
+    if not shards.submit(entries, lambda ok: loop.call_soon_threadsafe(_settle, ok), block=False):
+        return None
+    INGESTED.inc(len(entries), source="bulk")
+    return future
+
+
+@app.post("/logs/bulk")
+async def bulk_logs(request: Request):
+    """
+    Ingest a streamed NDJSON body (gzip with `Content-Encoding: gzip`), one
+    log object per line, parsed as it arrives and written in batches through
+    the same writer as the consumer. Responds once the lines are committed.
+    If the write buffer fills up the request stops with 429 and Retry-After;
+    `count` in the body says how many leading lines were accepted, so the
+    client can resend only the rest.
+    """
+    gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+    loop = asyncio.get_running_loop()
+    pending = []
+    batch = []
+    accepted = 0
+
+    async def _flush() -> bool:
+        nonlocal accepted, batch
+        future = await run_in_threadpool(_submit_bulk, batch, loop)
+        if future is None:
+            return False
+        pending.append(future)
+        accepted += len(batch)
+        batch = []
+        return True
+
+    try:
+        async for line in iter_ndjson(request.stream(), gzipped, BULK_MAX_LINE_BYTES):
+            batch.append(line)
+            if len(batch) >= BULK_BATCH_SIZE and not await _flush():
+                break
+        else:
+            if batch:
+                await _flush()
+    except LineTooLong:
+        raise HTTPException(status_code=413, detail=f"Log line longer than {BULK_MAX_LINE_BYTES} bytes")
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+
+    shards.flush()
+    if pending and not all(await asyncio.gather(*pending)):
+        raise HTTPException(status_code=500, detail="Failed to store logs")
+    if batch:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Log write buffer is full", "count": accepted},
+            headers={"Retry-After": str(BULK_RETRY_AFTER)},
+        )
+    return {"message": "Logs stored", "count": accepted}
+
+
 def _parse_date(value: str, end: bool = False) -> datetime:
     try:
         dt = datetime.fromisoformat(value)
     except Exception:
         raise HTTPException(status_code=400, detail=f"Invalid date format: {value}")
 
-    if end:
-        return dt + timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)
-    return dt
+    if end and len(value) == 10:
+        dt = dt + timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)
+    return dt.replace(tzinfo=dt.tzinfo or timezone.utc)
 
 
-@app.get("/logs/{datumOd}/{datumDo}")
-def get_logs_between(datumOd: str, datumDo: str):
-    start = _parse_date(datumOd)
-    end = _parse_date(datumDo, end=True)
-    with get_db_conn() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, timestamp, level, url, correlation_id, service, message, raw
-            FROM logs
-            WHERE timestamp BETWEEN ? AND ?
-            ORDER BY timestamp ASC
-            """,
-            (start.isoformat(), end.isoformat()),
-        ).fetchall()
-
-    results = []
-    for r in rows:
+def _serialize_row(r, raw: bool = True, shard: Optional[int] = None) -> dict:
+    item = {
+        "id": r["id"],
+        "timestamp": r["timestamp"],
+        "level": r["level"],
+        "url": r["url"],
+        "correlation_id": r["correlation_id"],
+        "service": r["service"],
+        "method": r["method"],
+        "status_code": r["status_code"],
+        "detail": r["detail"],
+        "message": r["message"],
+    }
+    if shard is not None:
+        item["shard"] = shard
+    if raw:
+        item["raw"] = row_payload(r)
+    return item
+
+
+def _item(shard: int, r, raw: bool) -> dict:
+    # Ids count up per day (and shard), so sharded results say which shard
+    # and `key` names the row uniquely; it is also a cursor for the rows after it.
+    item = _serialize_row(r, raw, shard if len(shards) > 1 else None)
+    item["key"] = _encode_cursor(shard, r)
+    return item
+
+
+def _encode_cursor(shard: int, r) -> str:
+    if len(shards) == 1:
+        return f"{r['ts']}:{r['id']}"
+    return f"{r['ts']}:{r['id']}:{shard}"
+
+
+def _decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        ts, row_id, *rest = (int(part) for part in cursor.split(":"))
+        shard = rest[0] if rest else 0
+        if len(rest) > 1 or not 0 <= shard < len(shards):
+            raise ValueError()
+        return ts, row_id, shard
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+
+def _range_query(start_ts: int, end_ts: int):
+    def query(shard: Shard, conn, after):
+        return iter_range(shard.store, conn, start_ts, end_ts, after=after)
+
+    return query
+
+
+def _search_query(start_ts: int, end_ts: int, **kwargs):
+    def query(shard: Shard, conn, after):
+        return shard.store.query_range(conn, start_ts, end_ts, after=after, **kwargs)
+
+    return query
+
+
+def _serialize_page(rows: list, limit: int, raw: bool):
+    next_cursor = _encode_cursor(*rows[limit - 1]) if len(rows) > limit else None
+    return [_item(shard, r, raw) for shard, r in rows[:limit]], next_cursor
+
+
+async def _fetch_page(query, limit: int, cursor, raw: bool):
+    rows = await shards.page(query, limit + 1, cursor)
+    return await run_in_threadpool(_serialize_page, rows, limit, raw)
+
+
+def _serialize_lines(rows: list, raw: bool) -> list:
+    return [json.dumps(_item(shard, r, raw), default=str) for shard, r in rows]
+
+
+async def _prepend(head: str, rest):
+    yield head
+    async for chunk in rest:
+        yield chunk
+
+
+async def _stream_rows(start_ts: int, end_ts: int, cursor, ndjson: bool, raw: bool):
+    # Shard rows are read on the read pools and merged here; serializing runs
+    # on the threadpool so the event loop only moves chunks along.
+    chunks = shards.stream(_range_query(start_ts, end_ts), STREAM_CHUNK_SIZE, cursor)
+    try:
+        # The first chunk takes a read connection on every shard before any
+        # output, so a busy pool still turns into a 503.
+        rows = await anext(chunks, None)
+        yield "" if ndjson else "["
+        first = True
+        while rows:
+            lines = await run_in_threadpool(_serialize_lines, rows, raw)
+            if ndjson:
+                yield "\n".join(lines) + "\n"
+            else:
+                yield ("" if first else ",") + ",".join(lines)
+            first = False
+            rows = await anext(chunks, None)
+        if not ndjson:
+            yield "]"
+    finally:
+        await chunks.aclose()
+
+
+@app.get("/logs/rollups")
+async def get_rollups(
+    start: str,
+    end: str,
+    service: Optional[str] = None,
+    path: Optional[str] = None,
+    interval: Optional[int] = Query(None, ge=1),
+):
+    """
+    Request counts, error rate and latency percentiles per service and route,
+    read from the per-minute rollups. `interval` (minutes) splits the window
+    into a time series; without it the whole window is one bucket.
+    """
+    start_ts = to_epoch_us(_parse_date(start))
+    end_ts = to_epoch_us(_parse_date(end, end=True))
+    parts = await asyncio.gather(
+        *(shard.read_pool.run(collect_rollups, start_ts, end_ts, service, path, interval) for shard in shards)
+    )
+    return summarize_rollups(merge_rollups(parts), start_ts, end_ts, interval)
+
+
+async def _export_chunks(start_ts: int, end_ts: int, writer):
+    chunks = shards.stream(_range_query(start_ts, end_ts), EXPORT_CHUNK_SIZE)
+    try:
+        rows = await anext(chunks, None)
+        while rows:
+            frame = await run_in_threadpool(Frame.from_rows, [r for _, r in rows])
+            yield await run_in_threadpool(writer.write, frame)
+            rows = await anext(chunks, None)
+        yield await run_in_threadpool(writer.close)
+    finally:
+        await chunks.aclose()
+
+
+@app.get("/logs/export")
+async def export_logs(start: str, end: str, format: str = Query("npz", pattern="^(npz|arrow)$")):
+    """
+    Typed columns (ts, service, level, path, method, status_code, latency_ms,
+    sample_rate) of a time range for offline analysis, streamed in chunks of
+    `LOG_EXPORT_CHUNK_SIZE` rows: a NumPy `.npz` archive, or an Arrow IPC
+    stream with `format=arrow` when pyarrow is installed.
+    """
+    if format == "arrow" and pa is None:
+        raise HTTPException(status_code=501, detail="Arrow export needs pyarrow installed")
+    start_ts = to_epoch_us(_parse_date(start))
+    end_ts = to_epoch_us(_parse_date(end, end=True))
+    writer = EXPORT_FORMATS[format]()
+    body = _export_chunks(start_ts, end_ts, writer)
+    head = await body.__anext__()
+    filename = f"logs-{start}-{end}.{writer.suffix}".replace(":", "")
+    return StreamingResponse(
+        _prepend(head, body),
+        media_type=writer.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _load_frame(conn, shard: Shard, start_ts: int, end_ts: int) -> Frame:
+    return load_frame(shard.store, conn, start_ts, end_ts, AGGREGATE_MAX_ROWS, EXPORT_CHUNK_SIZE)
+
+
+@app.get("/logs/aggregate")
+async def aggregate_logs(
+    start: str,
+    end: str,
+    by: str = "service,path",
+    service: Optional[str] = None,
+    level: Optional[str] = None,
+    method: Optional[str] = None,
+    requests_only: bool = True,
+):
+    """
+    Exact request counts, error rate and latency percentiles grouped by any of
+    service, path, level, method and status_class, computed over the raw rows
+    of the range with NumPy. `requests_only` keeps rows with a status code.
+    """
+    keys = [key.strip() for key in by.split(",") if key.strip()]
+    unknown = [key for key in keys if key not in GROUP_KEYS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot group by {unknown}, expected {GROUP_KEYS}")
+    start_ts = to_epoch_us(_parse_date(start))
+    end_ts = to_epoch_us(_parse_date(end, end=True))
+    try:
+        frames = await asyncio.gather(
+            *(shard.read_pool.run(_load_frame, shard, start_ts, end_ts) for shard in shards)
+        )
+    except TooManyRows:
+        frames = None
+    if frames is None or sum(len(frame) for frame in frames) > AGGREGATE_MAX_ROWS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"More than {AGGREGATE_MAX_ROWS} rows in range; narrow it or use /logs/export",
+        )
+    filters = {
+        "service": service,
+        "level": level.upper() if level else None,
+        "method": method.upper() if method else None,
+    }
+    return await run_in_threadpool(_aggregate, frames, keys, filters, requests_only)
+
+
+def _aggregate(frames: list, keys: list, filters: dict, requests_only: bool) -> list:
+    frame = Frame.concat(frames)
+    mask = frame.status_code > 0 if requests_only else None
+    for column, value in filters.items():
+        if value is not None:
+            match = frame.mask_equal(column, value)
+            mask = match if mask is None else mask & match
+    if mask is not None:
+        frame = frame.select(mask)
+    return aggregate(frame, keys)
+
+
+@app.get("/logs/trace/{correlation_id}")
+async def trace_logs(
+    correlation_id: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    raw: bool = False,
+):
+    """
+    Every entry logged for one correlation id across all services, in order,
+    plus a per-hop latency waterfall built from the "Request handled" entries.
+    """
+    start_ts = to_epoch_us(_parse_date(start)) if start else 0
+    end_ts = to_epoch_us(_parse_date(end, end=True)) if end else 2**62
+    rows = await shards.page(
+        _search_query(start_ts, end_ts, filters={"correlation_id": correlation_id}), MAX_PAGE_SIZE
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="No logs for this correlation id")
+    entries, waterfall = await run_in_threadpool(_trace, rows, raw)
+    return {"correlation_id": correlation_id, "entries": entries, "waterfall": waterfall}
+
+
+def _trace(rows: list, raw: bool):
+    entries = [_item(shard, r, raw) for shard, r in rows]
+    timed = [{**entry, "ts": r["ts"]} for (_, r), entry in zip(rows, entries)]
+    return entries, build_waterfall(timed)
+
+
+def _tail_matches(entry: dict, service, level, correlation_id) -> bool:
+    return (
+        (service is None or entry.get("service") == service)
+        and (level is None or str(entry.get("level") or "").upper() == level)
+        and (correlation_id is None or entry.get("correlation_id") == correlation_id)
+    )
+
+
+@app.get("/logs/tail")
+async def tail_logs(
+    request: Request,
+    service: Optional[str] = None,
+    level: Optional[str] = None,
+    correlation_id: Optional[str] = None,
+    backlog: int = Query(0, ge=0),
+):
+    """
+    Server-sent events with entries as they are committed, filtered by
+    service, level and correlation id. Served from the in-memory tail buffer,
+    never from SQLite. `backlog` replays up to that many recent entries first;
+    a reconnect with `Last-Event-ID` resumes where the stream left off while
+    the buffer still holds it, or after a restart with everything the new
+    process has buffered. A `dropped` event reports entries a slow viewer
+    missed.
+    """
+    level = level.upper() if level else None
+    seq = tail.resume_from(request.headers.get("last-event-id"))
+    if seq is None:
+        seq = max(tail.seq - backlog, 0)
+
+    async def events(seq: int):
+        tail.viewers += 1
         try:
-            raw_payload = json.loads(r["raw"]) if r["raw"] else None
-        except Exception:
-            raw_payload = r["raw"]
-        results.append(
-            {
-                "id": r["id"],
-                "timestamp": r["timestamp"],
-                "level": r["level"],
-                "url": r["url"],
-                "correlation_id": r["correlation_id"],
-                "service": r["service"],
-                "message": r["message"],
-                "raw": raw_payload,
-            }
+            while True:
+                items, dropped = tail.since(seq)
+                if dropped:
+                    yield f"event: dropped\ndata: {dropped}\n\n"
+                if items:
+                    seq = items[-1][0]
+                    chunk = "".join(
+                        f"id: {tail.event_id(n)}\ndata: {json.dumps(tail_item(entry), default=str)}\n\n"
+                        for n, entry in items
+                        if _tail_matches(entry, service, level, correlation_id)
+                    )
+                    if chunk:
+                        yield chunk
+                if not await tail.wait(seq, TAIL_KEEPALIVE):
+                    yield ": keepalive\n\n"
+        finally:
+            tail.viewers -= 1
+
+    return StreamingResponse(
+        events(seq),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/logs/{datumOd}/{datumDo}")
+async def get_logs_between(
+    datumOd: str,
+    datumDo: str,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    raw: bool = True,
+):
+    """
+    Without `limit` the whole range is streamed (a JSON array, or NDJSON with
+    `format=ndjson`). With `limit` one keyset page is returned together with
+    the cursor for the next one. `raw=false` leaves out the rebuilt payload.
+    `id` restarts in every day partition; `key` is unique across the range.
+    """
+    start_ts = to_epoch_us(_parse_date(datumOd))
+    end_ts = to_epoch_us(_parse_date(datumDo, end=True))
+    after = _decode_cursor(cursor)
+    ndjson = format == "ndjson"
+
+    if limit is None:
+        body = _stream_rows(start_ts, end_ts, after, ndjson, raw)
+        # Take the first chunk here so a busy pool is a 503, not a cut-off stream.
+        head = await body.__anext__()
+        return StreamingResponse(
+            _prepend(head, body),
+            media_type="application/x-ndjson" if ndjson else "application/json",
         )
 
-    return results
+    limit = min(limit, MAX_PAGE_SIZE)
+    items, next_cursor = await _fetch_page(_range_query(start_ts, end_ts), limit, after, raw)
+
+    if ndjson:
+        body = "".join(json.dumps(item, default=str) + "\n" for item in items)
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+        return Response(body, media_type="application/x-ndjson", headers=headers)
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@app.get("/logs/search")
+async def search_logs(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    service: Optional[str] = None,
+    level: Optional[str] = None,
+    url: Optional[str] = None,
+    method: Optional[str] = None,
+    status_code: Optional[int] = None,
+    correlation_id: Optional[str] = None,
+    q: Optional[str] = None,
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    raw: bool = True,
+):
+    """
+    Filter logs by service, level, url prefix, method, status code and
+    correlation id, with optional FTS5 full-text search over `message` via
+    `q`. Paginated like the range endpoint.
+    """
+    start_ts = to_epoch_us(_parse_date(start)) if start else 0
+    end_ts = to_epoch_us(_parse_date(end, end=True)) if end else 2**62
+    filters = {
+        "service": service,
+        "level": level.upper() if level else None,
+        "method": method.upper() if method else None,
+        "status_code": status_code,
+        "correlation_id": correlation_id,
+    }
+    limit = min(limit, MAX_PAGE_SIZE)
+    try:
+        items, next_cursor = await _fetch_page(
+            _search_query(start_ts, end_ts, filters=filters, url_prefix=url, text=q),
+            limit,
+            _decode_cursor(cursor),
+            raw,
+        )
+    except sqlite3.OperationalError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {exc}")
+    return {"items": items, "next_cursor": next_cursor}
 
 
 @app.delete("/logs")
 def delete_logs():
-    with get_db_conn() as conn:
-        conn.execute("DELETE FROM logs")
-        conn.commit()
+    segments = []
+    for shard in shards:
+        with shard.store.connect() as conn:
+            segments += [r["path"] for r in shard.store.archives(conn)]
+            shard.store.drop_all(conn)
+            conn.commit()
+    remove_segments(segments)
     return {"message": "All logs deleted"}
@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import os
+import threading
+import zlib
+from collections import deque
+from contextlib import AsyncExitStack
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from readpool import ReadPool
+from storage import LogStore
+
+SHARD_KEYS = ("service", "correlation_id")
+# Past any real row id, so `(ts, MAX_ID)` skips every row at `ts`.
+MAX_ID = 2**62
+
+# (ts, id, shard) of the last row a client has seen.
+Cursor = Tuple[int, int, int]
+# query(shard, conn, after) -> rows of that shard ordered by (ts, id)
+ShardQuery = Callable[["Shard", object, Optional[Tuple[int, int]]], Iterator]
+
+
+def shard_paths(db_path: str, count: int) -> List[str]:
+    """Shard 0 keeps `db_path`, so a single-file database becomes shard 0 as is."""
+    root, ext = os.path.splitext(db_path)
+    return [db_path] + [f"{root}-{index}{ext}" for index in range(1, count)]
+
+
+def shard_archive_dir(archive_dir: str, index: int) -> str:
+    return archive_dir if index == 0 else os.path.join(archive_dir, f"shard-{index}")
+
+
+def _take(conn, query: ShardQuery, shard: "Shard", after, limit: int) -> list:
+    return list(islice(query(shard, conn, after), limit))
+
+
+def _chunk(rows: Iterator, size: int) -> list:
+    return list(islice(rows, size))
+
+
+class Shard:
+    def __init__(self, index: int, store: LogStore, read_pool: ReadPool, archive_dir: str):
+        self.index = index
+        self.store = store
+        self.read_pool = read_pool
+        self.archive_dir = archive_dir
+        self.writer = None
+        self.retention = None
+        # Kept out of the read pool, so /metrics still answers when every
+        # pooled connection is busy.
+        self._catalog = None
+        self._catalog_lock = threading.Lock()
+
+    def partition_rows(self) -> List[Tuple[str, int]]:
+        with self._catalog_lock:
+            if self._catalog is None:
+                self._catalog = self.store.connect_readonly()
+            return self.store.partition_rows(self._catalog)
+
+    def close(self):
+        with self._catalog_lock:
+            if self._catalog is not None:
+                self._catalog.close()
+                self._catalog = None
+
+
+class ShardSet:
+    """
+    Log storage spread over several SQLite files, each with its own writer and
+    read pool. Entries go to the shard picked by a stable hash of `key`
+    (service or correlation id). Reads run on every shard in parallel and are
+    merged on (ts, shard, id), which is the global order cursors refer to.
+
+    Sharding keeps each file, its indexes and its retention passes smaller,
+    and lets queries over a wide range scan the files side by side. It does
+    not raise ingest throughput: one consumer thread decodes and routes every
+    message and the writers are threads of this process, so a second shard
+    only adds commits (bench.py, 1 CPU: ~9k rows/s with one shard, ~6k with
+    three). LOG_SHARDS defaults to 1.
+    """
+
+    def __init__(self, shards: List[Shard], key: str = "service"):
+        if key not in SHARD_KEYS:
+            raise ValueError(f"Unknown shard key {key!r}, expected one of {SHARD_KEYS}")
+        self.shards = shards
+        self.key = key
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def route(self, entry: dict) -> int:
+        if len(self.shards) == 1:
+            return 0
+        value = entry.get(self.key)
+        if value is None:
+            # No key to keep together; spread by time instead of piling onto one shard.
+            return entry["ts"] % len(self.shards)
+        return zlib.crc32(str(value).encode("utf-8")) % len(self.shards)
+
+    def split(self, entries: List[dict]) -> Dict[int, List[dict]]:
+        parts: Dict[int, List[dict]] = {}
+        for entry in entries:
+            parts.setdefault(self.route(entry), []).append(entry)
+        return parts
+
+    # Writes
+
+    def submit(self, entries: List[dict], callback=None, block: bool = True) -> bool:
+        """
+        Hand each shard its part of `entries`; `callback(ok)` runs once every
+        part has committed. With `block=False`, returns False without queueing
+        anything when a target writer is full.
+        """
+        parts = self.split(entries)
+        writers = {index: self.shards[index].writer for index in parts}
+        if not block and any(w.buffered >= w.max_buffer for w in writers.values()):
+            return False
+        if not parts:
+            if callback:
+                callback(True)
+            return True
+
+        pending = [len(parts), True]
+        lock = threading.Lock()
+
+        def _part_done(ok: bool):
+            with lock:
+                pending[0] -= 1
+                pending[1] = pending[1] and ok
+                finished = pending[0] == 0
+            if finished and callback:
+                callback(pending[1])
+
+        for index, part in parts.items():
+            writers[index].submit(part, _part_done)
+        return True
+
+    def write(self, entries: List[dict], timeout: Optional[float] = None) -> bool:
+        done = threading.Event()
+        result = []
+
+        def _callback(ok: bool):
+            result.append(ok)
+            done.set()
+
+        self.submit(entries, _callback)
+        self.flush()
+        if not done.wait(timeout):
+            return False
+        return result[0]
+
+    def flush(self):
+        for shard in self.shards:
+            shard.writer.flush()
+
+    # Reads
+
+    @staticmethod
+    def after_for(cursor: Optional[Cursor], index: int) -> Optional[Tuple[int, int]]:
+        """Translate a global cursor into the keyset position within one shard."""
+        if cursor is None:
+            return None
+        ts, row_id, shard = cursor
+        if index == shard:
+            return ts, row_id
+        # Rows at the cursor's ts sort by shard first.
+        return (ts, MAX_ID) if index < shard else (ts, -1)
+
+    async def page(self, query: ShardQuery, limit: int, cursor: Optional[Cursor] = None) -> List[tuple]:
+        """Up to `limit` `(shard, row)` pairs in global order, read from all shards at once."""
+        results = await asyncio.gather(
+            *(
+                shard.read_pool.run(_take, query, shard, self.after_for(cursor, shard.index), limit)
+                for shard in self.shards
+            )
+        )
+        if len(results) == 1:
+            return [(0, row) for row in results[0]]
+        tagged = (
+            [((row["ts"], index, row["id"]), index, row) for row in rows]
+            for index, rows in enumerate(results)
+        )
+        merged = heapq.merge(*tagged, key=lambda item: item[0])
+        return [(index, row) for _, index, row in islice(merged, limit)]
+
+    async def stream(self, query: ShardQuery, chunk_size: int, cursor: Optional[Cursor] = None):
+        """
+        Yield lists of `(shard, row)` in global order. Each shard holds one
+        read connection for the whole stream and always has its next chunk
+        loading while the current one is merged.
+        """
+        async with AsyncExitStack() as stack:
+            sources = []
+            for shard in self.shards:
+                conn = await stack.enter_async_context(shard.read_pool.connection())
+                rows = query(shard, conn, self.after_for(cursor, shard.index))
+                stack.callback(rows.close)
+                sources.append((shard, rows))
+
+            def _load(index: int):
+                shard, rows = sources[index]
+                return asyncio.ensure_future(shard.read_pool.call(_chunk, rows, chunk_size))
+
+            loading = [_load(index) for index in range(len(sources))]
+            stack.push_async_callback(_settle, loading)
+            buffers = [deque() for _ in sources]
+            done = [False] * len(sources)
+
+            async def _refill(index: int):
+                chunk = await loading[index]
+                if len(chunk) < chunk_size:
+                    done[index] = True
+                else:
+                    loading[index] = _load(index)
+                buffers[index].extend(chunk)
+
+            heap = []
+            for index in range(len(sources)):
+                await _refill(index)
+                if buffers[index]:
+                    row = buffers[index][0]
+                    heap.append((row["ts"], index, row["id"]))
+            heapq.heapify(heap)
+
+            out = []
+            while heap:
+                _, index, _ = heapq.heappop(heap)
+                out.append((index, buffers[index].popleft()))
+                if not buffers[index] and not done[index]:
+                    await _refill(index)
+                if buffers[index]:
+                    row = buffers[index][0]
+                    heapq.heappush(heap, (row["ts"], index, row["id"]))
+                if len(out) >= chunk_size:
+                    yield out
+                    out = []
+            if out:
+                yield out
+
+
+async def _settle(tasks):
+    # A chunk already running on a read thread cannot be interrupted; let it
+    # finish before its rows are closed and its connection goes back to the pool.
+    await asyncio.gather(*tasks, return_exceptions=True)
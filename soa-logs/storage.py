@@ -0,0 +1,517 @@
+import json
+import re
+import sqlite3
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional, Tuple
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+DAY_US = 86_400_000_000
+
+SCHEMA_VERSION = 5
+
+LOG_COLUMNS = (
+    "id, ts, timestamp, level, url, correlation_id, service, method, status_code, "
+    "detail, message, extra, raw, latency_ms, sample_rate"
+)
+# Fields stored in their own columns; anything else a producer sends goes to
+# `extra`. `formatted` only repeats the other fields, so it is not kept.
+TYPED_FIELDS = (
+    "timestamp", "level", "message", "service", "correlation_id", "url",
+    "method", "status_code", "detail",
+)
+DROPPED_FIELDS = ("ts", "formatted")
+COMPRESS_MIN_BYTES = 128
+FILTER_COLUMNS = ("service", "level", "method", "status_code", "correlation_id")
+DURATION_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*ms\s*$")
+
+
+def to_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def to_epoch_us(dt: datetime) -> int:
+    return (to_utc(dt) - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch_us(ts: int) -> datetime:
+    return EPOCH + timedelta(microseconds=ts)
+
+
+def partition_day(ts: int) -> str:
+    return from_epoch_us(ts).strftime("%Y%m%d")
+
+
+class LogStore:
+    """
+    Day-partitioned log storage. Each UTC day lives in its own `logs_YYYYMMDD`
+    table keyed by an integer `ts` (microseconds since epoch), and the
+    `log_partitions` catalog records which days exist and how many rows each
+    holds, so a range query only touches the days it overlaps and dropping a
+    day is a single DROP TABLE.
+    Days moved out to archive segments are listed in `log_archives`.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._known: set = set()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect_readonly(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def init(self):
+        with self.connect() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Needed so retention can hand pages back with incremental_vacuum;
+                # switching an existing database takes one full VACUUM.
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS log_partitions (
+                    day TEXT PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    start_ts INTEGER NOT NULL,
+                    end_ts INTEGER NOT NULL,
+                    rows INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS log_archives (
+                    day TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    rows INTEGER NOT NULL,
+                    max_id INTEGER NOT NULL,
+                    start_ts INTEGER NOT NULL,
+                    end_ts INTEGER NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._known = {r["day"] for r in conn.execute("SELECT day FROM log_partitions")}
+            self._upgrade_partitions(conn)
+            self._migrate_legacy(conn)
+
+    def _upgrade_partitions(self, conn: sqlite3.Connection):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        catalog = {r["name"] for r in conn.execute("PRAGMA table_info(log_partitions)")}
+        if "rows" not in catalog:
+            conn.execute("ALTER TABLE log_partitions ADD COLUMN rows INTEGER NOT NULL DEFAULT 0")
+        for _, table in self.partitions(conn):
+            columns = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+            if version < 2:
+                if "method" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN method TEXT")
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN status_code INTEGER")
+                    conn.execute(
+                        f"""
+                        UPDATE {table} SET
+                            method = json_extract(raw, '$.method'),
+                            status_code = json_extract(raw, '$.status_code')
+                        WHERE json_valid(raw)
+                        """
+                    )
+                self._create_partition_indexes(conn, table)
+                conn.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+            if version < 3 and "detail" not in columns:
+                # Rows written before v3 keep their full `raw` payload.
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN detail TEXT")
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN extra BLOB")
+                conn.execute(
+                    f"UPDATE {table} SET detail = json_extract(raw, '$.detail') WHERE json_valid(raw)"
+                )
+            if version < 4 and "latency_ms" not in columns:
+                # Derived once here so aggregations read plain numbers, not detail text.
+                conn.create_function("log_latency_ms", 1, parse_duration_ms, deterministic=True)
+                conn.create_function("log_sample_rate", 2, stored_sample_rate, deterministic=True)
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN latency_ms REAL")
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN sample_rate REAL")
+                conn.execute(
+                    f"""
+                    UPDATE {table} SET
+                        latency_ms = log_latency_ms(detail),
+                        sample_rate = log_sample_rate(extra, raw)
+                    """
+                )
+            if version < 5:
+                conn.execute(
+                    f"UPDATE log_partitions SET rows = (SELECT count(*) FROM {table}) WHERE table_name = ?",
+                    (table,),
+                )
+            conn.commit()
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+    def _migrate_legacy(self, conn: sqlite3.Connection):
+        legacy = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'logs'"
+        ).fetchone()
+        if not legacy:
+            return
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, timestamp, raw FROM logs WHERE id > ? ORDER BY id LIMIT 5000", (last_id,)
+            ).fetchall()
+            if not rows:
+                break
+            entries = []
+            for r in rows:
+                try:
+                    entry = json.loads(r["raw"])
+                except Exception:
+                    entry = None
+                if not isinstance(entry, dict):
+                    entry = {"message": r["raw"]}
+                entry.setdefault("timestamp", r["timestamp"])
+                entries.append(normalize_entry(entry))
+            self.insert(conn, entries)
+            conn.commit()
+            last_id = rows[-1]["id"]
+        conn.execute("DROP TABLE logs")
+        conn.commit()
+
+    def _ensure_partition(self, conn: sqlite3.Connection, day: str) -> str:
+        table = f"logs_{day}"
+        if day in self._known:
+            return table
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                ts INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                level TEXT,
+                url TEXT,
+                correlation_id TEXT,
+                service TEXT,
+                method TEXT,
+                status_code INTEGER,
+                detail TEXT,
+                message TEXT,
+                extra BLOB,
+                raw TEXT,
+                latency_ms REAL,
+                sample_rate REAL
+            )
+            """
+        )
+        self._create_partition_indexes(conn, table)
+        start = to_epoch_us(datetime.strptime(day, "%Y%m%d"))
+        conn.execute(
+            "INSERT OR IGNORE INTO log_partitions (day, table_name, start_ts, end_ts) VALUES (?, ?, ?, ?)",
+            (day, table, start, start + DAY_US - 1),
+        )
+        self._known.add(day)
+        return table
+
+    def _create_partition_indexes(self, conn: sqlite3.Connection, table: str):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table}(ts)")
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_service_ts ON {table}(service, ts)"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_correlation ON {table}(correlation_id, ts)"
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_level_ts ON {table}(level, ts)")
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_status_ts ON {table}(status_code, ts)"
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_url ON {table}(url)")
+        # External-content FTS5 index over `message`, kept in sync by trigger at ingest.
+        conn.execute(
+            f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts
+            USING fts5(message, content='{table}', content_rowid='id')
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts(rowid, message) VALUES (new.id, new.message);
+            END
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+            END
+            """
+        )
+
+    def reset_cache(self):
+        """
+        Forget which partitions exist. Call after a rolled-back insert, whose
+        CREATE TABLE went with it, or when a partition may have been dropped
+        behind the cache.
+        """
+        self._known.clear()
+
+    def insert(self, conn: sqlite3.Connection, entries: List[dict]):
+        by_day = {}
+        for entry in entries:
+            by_day.setdefault(partition_day(entry["ts"]), []).append(entry)
+        for day, chunk in by_day.items():
+            table = self._ensure_partition(conn, day)
+            conn.execute("UPDATE log_partitions SET rows = rows + ? WHERE day = ?", (len(chunk), day))
+            # Late rows for an archived day continue after the archived ids, so
+            # (ts, id) stays unique across the segment and the partition. Read
+            # inside this transaction, so a rollback cannot lose the floor.
+            floor = conn.execute(
+                f"""
+                SELECT max_id FROM log_archives
+                WHERE day = ? AND max_id > (SELECT coalesce(max(id), 0) FROM {table})
+                """,
+                (day,),
+            ).fetchone()
+            if floor is not None:
+                conn.execute(
+                    f"""
+                    INSERT INTO {table} (
+                        id, ts, timestamp, level, url, correlation_id, service,
+                        method, status_code, detail, message, extra, latency_ms, sample_rate
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (floor[0] + 1,) + _log_row(chunk[0]),
+                )
+                chunk = chunk[1:]
+            conn.executemany(
+                f"""
+                INSERT INTO {table} (
+                    ts, timestamp, level, url, correlation_id, service,
+                    method, status_code, detail, message, extra, latency_ms, sample_rate
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [_log_row(entry) for entry in chunk],
+            )
+
+    def partitions(
+        self, conn: sqlite3.Connection, start_ts: Optional[int] = None, end_ts: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
+        rows = conn.execute(
+            """
+            SELECT day, table_name FROM log_partitions
+            WHERE end_ts >= ? AND start_ts <= ?
+            ORDER BY day ASC
+            """,
+            (start_ts if start_ts is not None else 0, end_ts if end_ts is not None else 2**62),
+        ).fetchall()
+        return [(r["day"], r["table_name"]) for r in rows]
+
+    def query_range(
+        self,
+        conn: sqlite3.Connection,
+        start_ts: int,
+        end_ts: int,
+        after: Optional[Tuple[int, int]] = None,
+        filters: Optional[dict] = None,
+        url_prefix: Optional[str] = None,
+        text: Optional[str] = None,
+        min_id: Optional[int] = None,
+    ) -> Iterator[sqlite3.Row]:
+        # Days never overlap, so walking partitions in order keeps rows sorted
+        # by (ts, id); `after` is a keyset cursor from a previous page.
+        if after is not None:
+            start_ts = max(start_ts, after[0])
+        clauses = ["ts BETWEEN ? AND ?"]
+        params: list = [start_ts, end_ts]
+        for column, value in (filters or {}).items():
+            if column not in FILTER_COLUMNS:
+                raise ValueError(f"Unsupported filter: {column}")
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if url_prefix:
+            # A half-open range instead of LIKE so the url index can be used.
+            clauses.append("url >= ? AND url < ?")
+            params += [url_prefix, url_prefix + "\U0010ffff"]
+        if after is not None:
+            clauses.append("(ts, id) > (?, ?)")
+            params += list(after)
+        if min_id is not None:
+            clauses.append("id > ?")
+            params.append(min_id)
+
+        for _, table in self.partitions(conn, start_ts, end_ts):
+            where = list(clauses)
+            table_params = list(params)
+            if text:
+                where.append(f"id IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)")
+                table_params.append(text)
+            yield from conn.execute(
+                f"""
+                SELECT {LOG_COLUMNS} FROM {table}
+                WHERE {" AND ".join(where)}
+                ORDER BY ts ASC, id ASC
+                """,
+                table_params,
+            )
+
+    def partition_rows(self, conn: sqlite3.Connection) -> List[Tuple[str, int]]:
+        return [(r["day"], r["rows"]) for r in conn.execute("SELECT day, rows FROM log_partitions ORDER BY day")]
+
+    def delete_chunk(self, conn: sqlite3.Connection, day: str, max_id: int, limit: int) -> int:
+        table = f"logs_{day}"
+        cursor = conn.execute(
+            f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE id <= ? LIMIT ?)",
+            (max_id, limit),
+        )
+        conn.execute("UPDATE log_partitions SET rows = rows - ? WHERE day = ?", (cursor.rowcount, day))
+        return cursor.rowcount
+
+    def is_empty(self, conn: sqlite3.Connection, day: str) -> bool:
+        return conn.execute(f"SELECT 1 FROM logs_{day} LIMIT 1").fetchone() is None
+
+    def archives(
+        self, conn: sqlite3.Connection, start_ts: Optional[int] = None, end_ts: Optional[int] = None
+    ) -> List[sqlite3.Row]:
+        return conn.execute(
+            """
+            SELECT day, path, rows, max_id FROM log_archives
+            WHERE end_ts >= ? AND start_ts <= ?
+            ORDER BY day ASC
+            """,
+            (start_ts if start_ts is not None else 0, end_ts if end_ts is not None else 2**62),
+        ).fetchall()
+
+    def drop_partition(self, conn: sqlite3.Connection, day: str):
+        conn.execute(f"DROP TABLE IF EXISTS logs_{day}_fts")
+        conn.execute(f"DROP TABLE IF EXISTS logs_{day}")
+        conn.execute("DELETE FROM log_partitions WHERE day = ?", (day,))
+        self._known.discard(day)
+
+    def drop_all(self, conn: sqlite3.Connection):
+        for day, _ in self.partitions(conn):
+            self.drop_partition(conn, day)
+        conn.execute("DELETE FROM log_archives")
+
+
+def parse_timestamp(raw) -> datetime:
+    if not raw:
+        return datetime.now(timezone.utc)
+    try:
+        return to_utc(datetime.fromisoformat(str(raw).replace("Z", "+00:00")))
+    except Exception:
+        return datetime.now(timezone.utc)
+
+
+def normalize_entry(entry: dict) -> dict:
+    dt = parse_timestamp(entry.get("timestamp"))
+    entry["timestamp"] = dt.isoformat()
+    entry["ts"] = to_epoch_us(dt)
+    return entry
+
+
+def _status_code(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_duration_ms(detail) -> Optional[float]:
+    """Parse the `"12.34ms"` detail written by `init_request_logging`."""
+    if not isinstance(detail, str):
+        return None
+    match = DURATION_RE.match(detail)
+    return float(match.group(1)) if match else None
+
+
+def sampled_rate(value) -> Optional[float]:
+    """The rate a producer sampled at, or None when the entry was not sampled."""
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        return None
+    return rate if 0 < rate < 1 else None
+
+
+def stored_sample_rate(extra, raw) -> Optional[float]:
+    """`sampled_rate` of a row written before `sample_rate` had its own column."""
+    if raw:
+        try:
+            payload = json.loads(raw)
+        except Exception:
+            return None
+        return sampled_rate(payload.get("sample_rate")) if isinstance(payload, dict) else None
+    return sampled_rate(decode_extra(extra).get("sample_rate"))
+
+
+def _log_row(entry: dict):
+    # Producers may send any JSON in these fields; a value SQLite cannot bind
+    # would fail the whole group commit, so non-strings are stored as JSON text.
+    detail = _text(entry.get("detail"))
+    return (
+        entry["ts"],
+        entry["timestamp"],
+        _text(entry.get("level")),
+        _text(entry.get("url") or entry.get("path")),
+        _text(entry.get("correlation_id")),
+        _text(entry.get("service")),
+        _text(entry.get("method")) or None,
+        _status_code(entry.get("status_code")),
+        detail,
+        _text(entry.get("message")),
+        encode_extra(entry),
+        parse_duration_ms(detail),
+        sampled_rate(entry.get("sample_rate")),
+    )
+
+
+def _text(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def encode_extra(entry: dict):
+    extra = {
+        k: v for k, v in entry.items() if k not in TYPED_FIELDS and k not in DROPPED_FIELDS
+    }
+    if not extra:
+        return None
+    data = json.dumps(extra, default=str, separators=(",", ":"))
+    if len(data) < COMPRESS_MIN_BYTES:
+        return data
+    return zlib.compress(data.encode("utf-8"))
+
+
+def decode_extra(value) -> dict:
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, bytes):
+        value = zlib.decompress(value).decode("utf-8")
+    return json.loads(value)
+
+
+def row_payload(row):
+    """Rebuild the producer's payload from a stored row (or legacy `raw` JSON)."""
+    if row["raw"]:
+        try:
+            return json.loads(row["raw"])
+        except Exception:
+            return row["raw"]
+    payload = {field: row[field] for field in TYPED_FIELDS}
+    payload.update(decode_extra(row["extra"]))
+    return payload
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from collections import deque
+from itertools import islice
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+from storage import TYPED_FIELDS
+
+
+def tail_item(entry: dict) -> dict:
+    return {field: entry.get(field) for field in TYPED_FIELDS}
+
+
+class TailBuffer:
+    """
+    Ring of the most recently committed entries, each tagged with a sequence
+    number. Viewers keep their own position and read from the shared ring, so
+    any number of them costs one append per entry on the writer side. A
+    viewer that falls more than `size` entries behind skips ahead and is told
+    how many it missed. Event ids are `<epoch>-<seq>`, where the epoch is
+    new in every process, because sequence numbers restart with it.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.seq = 0
+        self.epoch = uuid4().hex[:8]
+        self._ring: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Optional[asyncio.Event] = None
+        self.viewers = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    def publish(self, entries: List[dict]):
+        """Append entries; safe to call from any thread."""
+        with self._lock:
+            for entry in entries:
+                self.seq += 1
+                self._ring.append((self.seq, entry))
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        # Waiters hold the old event; swapping in a new one re-arms the rest.
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def resume_from(self, event_id: Optional[str]) -> Optional[int]:
+        """
+        Where a viewer reconnecting with `Last-Event-ID` continues: after that
+        entry, or from the start of this process's entries when the id came
+        from an earlier one. None for a missing or unreadable id.
+        """
+        epoch, _, seq = (event_id or "").rpartition("-")
+        if not seq.isdigit():
+            return None
+        return min(int(seq), self.seq) if epoch == self.epoch else 0
+
+    def since(self, seq: int) -> Tuple[List[Tuple[int, dict]], int]:
+        """Entries after `seq`, and how many of those already fell off the ring."""
+        with self._lock:
+            if not self._ring or self.seq <= seq:
+                return [], 0
+            first = self._ring[0][0]
+            start = max(seq + 1, first)
+            return list(islice(self._ring, start - first, None)), start - seq - 1
+
+    async def wait(self, seq: int, timeout: float) -> bool:
+        """Wait until something newer than `seq` is published; False on timeout."""
+        if self.seq > seq:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
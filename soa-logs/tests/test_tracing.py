@@ -0,0 +1,37 @@
+from tracing import build_waterfall
+
+
+def _hop(service, start_us, duration_ms):
+    return {
+        "service": service,
+        "method": "GET",
+        "url": f"http://{service}/",
+        "status_code": 200,
+        "ts": start_us + int(duration_ms * 1000),
+        "detail": f"{duration_ms:.2f}ms",
+    }
+
+
+def test_duplicate_hops_are_counted_once():
+    entry = _hop("soa-login", 1_000_000, 50)
+    waterfall = build_waterfall([entry, dict(entry)])
+    assert len(waterfall["hops"]) == 1
+    assert waterfall["hops"][0]["self_ms"] == 50
+
+
+def test_identical_intervals_nest_without_cycles():
+    outer = _hop("soa-expense", 1_000_000, 80)
+    inner = dict(_hop("soa-login", 1_000_000, 80), url="http://soa-login/users/verify")
+    waterfall = build_waterfall([inner, outer, dict(outer)])
+    assert [h["depth"] for h in waterfall["hops"]] == [0, 1]
+    assert [h["self_ms"] for h in waterfall["hops"]] == [0, 80]
+
+
+def test_nested_and_sibling_hops():
+    root = _hop("soa-expense", 1_000_000, 100)
+    first = _hop("soa-login", 1_010_000, 30)
+    second = _hop("soa-login", 1_050_000, 20)
+    waterfall = build_waterfall([second, root, first])
+    assert [h["depth"] for h in waterfall["hops"]] == [0, 1, 1]
+    assert waterfall["hops"][0]["self_ms"] == 50
+    assert waterfall["services"]["soa-login"] == {"hops": 2, "total_ms": 50, "self_ms": 50}
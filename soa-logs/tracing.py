@@ -0,0 +1,82 @@
+from typing import List
+
+from storage import from_epoch_us, parse_duration_ms
+
+
+def build_waterfall(entries: List[dict]) -> dict:
+    """
+    Turn the "Request handled" entries of one correlation id into hops. Each
+    hop is logged when the response goes out, so it spans
+    [ts - duration, ts]; hops nested inside another hop's span are its
+    downstream calls and are subtracted from its self time.
+    """
+    hops = []
+    seen = set()
+    for entry in entries:
+        duration = parse_duration_ms(entry.get("detail"))
+        if duration is None:
+            continue
+        # A redelivered or resent record is the same hop stored twice.
+        key = (entry.get("service"), entry.get("method"), entry.get("url"), entry.get("status_code"), entry["ts"])
+        if key in seen:
+            continue
+        seen.add(key)
+        end_ms = entry["ts"] / 1000
+        hops.append(
+            {
+                "service": entry.get("service"),
+                "method": entry.get("method"),
+                "url": entry.get("url"),
+                "status_code": entry.get("status_code"),
+                "start_ms": end_ms - duration,
+                "end_ms": end_ms,
+                "duration_ms": duration,
+            }
+        )
+    if not hops:
+        return {"start": None, "total_ms": None, "hops": [], "services": {}}
+
+    hops.sort(key=lambda h: (h["start_ms"], -h["duration_ms"]))
+    origin = hops[0]["start_ms"]
+    total = max(h["end_ms"] for h in hops) - origin
+
+    # Sorted by start, a hop's parent is the innermost earlier hop still open
+    # when it starts, so parents always come first and nesting cannot cycle.
+    open_hops = []
+    for hop in hops:
+        while open_hops and open_hops[-1]["end_ms"] < hop["end_ms"]:
+            open_hops.pop()
+        parent = open_hops[-1] if open_hops else None
+        hop["depth"] = parent["depth"] + 1 if parent is not None else 0
+        hop["self_ms"] = hop["duration_ms"]
+        if parent is not None:
+            parent["self_ms"] -= hop["duration_ms"]
+        open_hops.append(hop)
+    for hop in hops:
+        hop["self_ms"] = max(hop["self_ms"], 0.0)
+
+    services = {}
+    result = []
+    for hop in hops:
+        stats = services.setdefault(hop["service"], {"hops": 0, "total_ms": 0.0, "self_ms": 0.0})
+        stats["hops"] += 1
+        stats["total_ms"] = round(stats["total_ms"] + hop["duration_ms"], 3)
+        stats["self_ms"] = round(stats["self_ms"] + hop["self_ms"], 3)
+        result.append(
+            {
+                "service": hop["service"],
+                "method": hop["method"],
+                "url": hop["url"],
+                "status_code": hop["status_code"],
+                "depth": hop["depth"],
+                "offset_ms": round(hop["start_ms"] - origin, 3),
+                "duration_ms": round(hop["duration_ms"], 3),
+                "self_ms": round(hop["self_ms"], 3),
+            }
+        )
+    return {
+        "start": from_epoch_us(int(origin * 1000)).isoformat(),
+        "total_ms": round(total, 3),
+        "hops": result,
+        "services": services,
+    }
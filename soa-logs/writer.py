@@ -0,0 +1,200 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+from metrics import Histogram
+
+logger = logging.getLogger("soa-logs.writer")
+
+Callback = Callable[[bool], None]
+
+APPLY_SECONDS = Histogram(
+    "soa_logs_writer_apply_seconds", "Time spent inserting one batch inside its transaction.", ("writer",)
+)
+COMMIT_SECONDS = Histogram(
+    "soa_logs_writer_commit_seconds", "Time spent in COMMIT for one batch, including the WAL fsync.", ("writer",)
+)
+
+
+class LogWriter(threading.Thread):
+    """
+    Single writer that owns one WAL-mode SQLite connection and group-commits
+    buffered entries. `apply(conn, entries)` does the inserts for one batch;
+    each submitter's callback runs after the transaction holding its entries
+    has committed (True) or rolled back (False), and `on_commit(entries)`, if
+    given, sees every committed batch. `on_rollback()` runs after every
+    rollback, so anything `apply` cached about the database can be dropped.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        apply: Callable[[sqlite3.Connection, List[dict]], None],
+        max_batch: int = 1000,
+        max_delay: float = 0.5,
+        max_buffer: int = 50000,
+        synchronous: str = "FULL",
+        on_commit: Optional[Callable[[List[dict]], None]] = None,
+        on_rollback: Optional[Callable[[], None]] = None,
+        name: str = "log-writer",
+    ):
+        super().__init__(name=name, daemon=True)
+        self.db_path = db_path
+        self.apply = apply
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.synchronous = synchronous
+        self.on_commit = on_commit
+        self.on_rollback = on_rollback
+
+        self._buffer: deque = deque()
+        self._buffered = 0
+        self._oldest_at: Optional[float] = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._flush_requested = False
+
+        self.committed_rows = 0
+        self.committed_batches = 0
+        self.failed_batches = 0
+        self.last_commit_ms: Optional[float] = None
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    @property
+    def buffered(self) -> int:
+        return self._buffered
+
+    def submit(self, entries: List[dict], callback: Optional[Callback] = None, block: bool = True) -> bool:
+        """
+        Queue entries for the next commit. While the buffer is full this waits
+        for room, or with `block=False` returns False without queueing them.
+        """
+        if not entries:
+            if callback:
+                callback(True)
+            return True
+        with self._cond:
+            while self._buffered >= self.max_buffer and not self._stopping:
+                if not block:
+                    return False
+                self._cond.wait()
+            first = not self._buffer
+            if first:
+                self._oldest_at = time.monotonic()
+            self._buffer.append((entries, callback))
+            self._buffered += len(entries)
+            # An idle writer waits without a deadline; the first entries start its clock.
+            if first or self._buffered >= self.max_batch:
+                self._cond.notify_all()
+        return True
+
+    def flush(self):
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+
+    def _take_batch(self):
+        batch = []
+        rows = 0
+        while self._buffer and rows < self.max_batch:
+            entries, callback = self._buffer.popleft()
+            batch.append((entries, callback))
+            rows += len(entries)
+        self._buffered -= rows
+        self._oldest_at = time.monotonic() if self._buffer else None
+        self._cond.notify_all()
+        return batch
+
+    def _transaction(self, conn: sqlite3.Connection, entries: List[dict]) -> bool:
+        started = time.perf_counter()
+        ok = True
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self.apply(conn, entries)
+            applied = time.perf_counter()
+            conn.execute("COMMIT")
+            APPLY_SECONDS.observe(applied - started, writer=self.name)
+            COMMIT_SECONDS.observe(time.perf_counter() - applied, writer=self.name)
+            self.committed_rows += len(entries)
+            self.committed_batches += 1
+        except Exception as exc:
+            ok = False
+            self.failed_batches += 1
+            logger.error("Log batch of %s rows failed: %s", len(entries), exc)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            if self.on_rollback:
+                self.on_rollback()
+        self.last_commit_ms = (time.perf_counter() - started) * 1000
+        return ok
+
+    def _commit(self, conn: sqlite3.Connection, batch):
+        entries = [entry for chunk, _ in batch for entry in chunk]
+        ok = self._transaction(conn, entries)
+        if not ok and len(batch) > 1:
+            # One bad submission must not fail the others that shared its
+            # transaction, so each is retried on its own.
+            for item in batch:
+                self._commit(conn, [item])
+            return
+        if ok and self.on_commit:
+            try:
+                self.on_commit(entries)
+            except Exception as exc:
+                logger.warning("Log commit hook failed: %s", exc)
+        for _, callback in batch:
+            if callback:
+                try:
+                    callback(ok)
+                except Exception as exc:
+                    logger.warning("Log batch callback failed: %s", exc)
+
+    def run(self):
+        conn = self._open()
+        try:
+            while True:
+                with self._cond:
+                    while not self._stopping:
+                        if self._buffered >= self.max_batch or self._flush_requested:
+                            break
+                        if self._oldest_at is not None:
+                            remaining = self.max_delay - (time.monotonic() - self._oldest_at)
+                            if remaining <= 0:
+                                break
+                            self._cond.wait(remaining)
+                        else:
+                            self._cond.wait()
+                    if self._stopping and not self._buffer:
+                        return
+                    batch = self._take_batch()
+                    if not self._buffer:
+                        self._flush_requested = False
+                if batch:
+                    self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": self._buffered,
+            "committed_rows": self.committed_rows,
+            "committed_batches": self.committed_batches,
+            "failed_batches": self.failed_batches,
+            "last_commit_ms": round(self.last_commit_ms, 3) if self.last_commit_ms else None,
+        }